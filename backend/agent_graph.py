@@ -1,11 +1,11 @@
 import os
+import math
+import bisect
 import operator
 from typing import List, TypedDict, Annotated, Dict, Any, Union, Optional
 from typing_extensions import TypedDict as ExtTypedDict
 
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langgraph.graph import StateGraph, END, START
 from langgraph.types import Send
@@ -19,6 +19,8 @@ load_dotenv(env_path)
 
 # Import RAG Engine
 import rag_engine
+import deck_store
+from generation_engine import GenerationClient
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 if not OPENROUTER_API_KEY:
@@ -35,6 +37,15 @@ llm = ChatOpenAI(
     }
 )
 
+# Stage Config
+# Flowcharts: one per document section (FLOWCHART_SECTION_BATCHES batches), at most MAX_FLOWCHARTS per deck.
+FLOWCHART_STAGE = os.getenv("FLOWCHART_STAGE", "true").lower() == "true"
+FLOWCHART_SECTION_BATCHES = int(os.getenv("FLOWCHART_SECTION_BATCHES", 4))
+MAX_FLOWCHARTS = int(os.getenv("MAX_FLOWCHARTS", 6))
+FLOWCHART_MAX_CARDS = int(os.getenv("FLOWCHART_MAX_CARDS", 40)) # Cards sampled per section flowchart
+# Vision transcriptions for RAG, indexed per batch as soon as each one arrives.
+VISION_TRANSCRIPTION = os.getenv("VISION_TRANSCRIPTION", "true").lower() == "true"
+
 # --- SCHEMAS ---
 
 class Flashcard(BaseModel):
@@ -44,162 +55,254 @@ class Flashcard(BaseModel):
 
 class CardList(BaseModel):
     cards: List[Flashcard]
-    flowchart: Optional[str] = Field(description="Mermaid.js code for the flowchart")
-    transcription: Optional[str] = Field(description="Detailed text summary/transcription for RAG")
+
+# One client per process: stable prompt prefix + schema-constrained, streamed output
+generation_client = GenerationClient(llm, CardList, Flashcard)
 
 # Main Graph State
 class DeckState(TypedDict):
-    original_text: Union[str, List[str]] # Text or List of Base64 Images
+    # One entry per uploaded file:
+    # {"file_name": str, "mode": "text" | "image", "pages": List[str]}
+    sources: List[Dict]
     # The reducer will automatically aggregate lists of lists (if we output list) 
     # OR we append to partial_cards list.
     partial_cards: Annotated[List[Dict], operator.add] 
     final_cards: List[Dict]
-    batches: List[List[str]] # Temp storage for mapper
+    batches: List[Dict] # Temp storage for mapper (BatchInput dicts)
+    sections: List[Dict] # Flowchart sections: {index, ranges: [{source_file, page_start, page_end}], batch_ids}
     deck_id: str
-    flowcharts: Annotated[List[str], operator.add]
-    transcriptions: Annotated[List[str], operator.add] # For RAG on Vision
+    section_flowcharts: Annotated[List[Dict], operator.add] # {section, chart}
+    flowcharts: List[str] # Merged, ordered by section
+    transcribed_batches: Annotated[int, operator.add]
 
 # Worker State (Input for Map)
 class BatchInput(TypedDict):
+    batch_id: int
     batch_content: List[str] # List of 5 images OR text chunk
+    mode: str # "text" | "image"
+    source_index: int # Position of the file in the upload (file names can repeat)
+    source_file: str
+    page_start: int
+    page_end: int
+    deck_id: str
+
+# Flowchart Worker State
+class SectionInput(TypedDict):
+    section: Dict
+    cards: List[Dict]
 
 # --- NODES ---
 
+def _page_for_offset(page_offsets: List[int], offset: int) -> int:
+    """
+    Maps a character offset in the joined file text back to its 1-based page number.
+    """
+    return max(bisect.bisect_right(page_offsets, offset), 1)
+
+def plan_sections(batches: List[Dict]) -> List[Dict]:
+    """
+    Groups consecutive batches of an uploaded file into flowchart sections, in upload/page order.
+    Files are keyed by upload position, so two uploads with the same name stay apart.
+    Section size grows until the deck fits in MAX_FLOWCHARTS; with more files than that,
+    neighbouring files share a section, and its 'ranges' list one page range per file.
+    """
+    if not batches or MAX_FLOWCHARTS <= 0:
+        return []
+
+    by_file: Dict[int, List[Dict]] = {}
+    for b in batches:
+        by_file.setdefault(b["source_index"], []).append(b)
+
+    size = max(FLOWCHART_SECTION_BATCHES, 1)
+    while True:
+        groups = [file_batches[i:i + size] for file_batches in by_file.values() for i in range(0, len(file_batches), size)]
+        if len(groups) <= MAX_FLOWCHARTS or size >= len(batches):
+            break
+        size *= 2
+    if len(groups) > MAX_FLOWCHARTS:
+        per_section = math.ceil(len(groups) / MAX_FLOWCHARTS)
+        groups = [sum(groups[i:i + per_section], []) for i in range(0, len(groups), per_section)]
+
+    sections = []
+    for index, group in enumerate(groups):
+        ranges: Dict[int, Dict] = {}
+        for b in group:
+            r = ranges.setdefault(b["source_index"], {
+                "source_file": b["source_file"], "page_start": b["page_start"], "page_end": b["page_end"]
+            })
+            r["page_start"] = min(r["page_start"], b["page_start"])
+            r["page_end"] = max(r["page_end"], b["page_end"])
+        sections.append({
+            "index": index,
+            "ranges": list(ranges.values()),
+            "batch_ids": [b["batch_id"] for b in group]
+        })
+    return sections
+
+def sample_section_cards(cards_by_batch: Dict[int, List[Dict]], batch_ids: List[int], max_cards: int) -> List[Dict]:
+    """
+    Up to max_cards cards spread evenly over a section's batches, in document order.
+    Each batch gets a max_cards // len(batches) quota; quota left by short batches goes round-robin to the rest.
+    (Taking the first max_cards would summarize only the section's first couple of batches.)
+    """
+    batches = [cards_by_batch[b] for b in batch_ids if cards_by_batch.get(b)]
+    if not batches or max_cards <= 0:
+        return []
+    if len(batches) > max_cards: # More batches than cards: evenly spaced batches, one card each
+        batches = [batches[i * len(batches) // max_cards] for i in range(max_cards)]
+    quota = max(max_cards // len(batches), 1)
+    taken = [min(len(cards), quota) for cards in batches]
+    spare = max_cards - sum(taken)
+    while spare > 0:
+        grew = False
+        for i, cards in enumerate(batches):
+            if spare > 0 and taken[i] < len(cards):
+                taken[i] += 1
+                spare -= 1
+                grew = True
+        if not grew:
+            break
+    return [c for cards, n in zip(batches, taken) for c in cards[:n]]
+
+def describe_section(section: Dict) -> str:
+    return ", ".join(f"{r['source_file']} p.{r['page_start']}-{r['page_end']}" for r in section["ranges"])
+
 def chunk_document(state: DeckState):
     """
-    MAPPER: splits content into batches.
-    Returns nothing to state, but determines valid edges via 'map_batches'
+    MAPPER: splits every uploaded file into batches.
+    Each batch remembers its file and page range so cards and RAG chunks can point back to it.
+    Returns the batches to state, which 'map_jobs' fans out.
     """
     print("--- NODE: CHUNKER (MAPPER) ---")
-    content = state['original_text']
+    sources = state.get('sources', [])
+    deck_id = state.get("deck_id", "default")
     
     batches = []
+    splitter = RecursiveCharacterTextSplitter(chunk_size=4000, chunk_overlap=200, add_start_index=True)
     
-    # 1. Vision Mode (List of images)
-    if isinstance(content, list):
-        BATCH_SIZE = 5
-        print(f"Vision Mode: {len(content)} pages. Batching by {BATCH_SIZE}...")
-        for i in range(0, len(content), BATCH_SIZE):
-            batches.append(content[i:i + BATCH_SIZE])
-            
-    # 2. Text Mode (String)
-    else:
-        text = str(content)
-        splitter = RecursiveCharacterTextSplitter(chunk_size=4000, chunk_overlap=200)
-        docs = splitter.create_documents([text])
-        # Text is simple, just list of strings
-        # We can also batch text chunks if we want, but usually 1 chunk = 1 context window is fine.
-        # Let's just treat each text chunk as a "batch" of 1 item for consistency?
-        # Or just pass the string.
-        text_chunks = [d.page_content for d in docs]
-        batches = [[c] for c in text_chunks] 
-
-    print(f"Created {len(batches)} batches/jobs.")
-    
-    # --- RAG INDEXING ---
-    if rag_engine and isinstance(content, str):
-        # We index the chunks we created for text
-        # If content is string (Text Mode)
-        # We'll use the chunks logic
-        if 'batches' not in locals(): # redundancy check
-             pass
-        # Flatten batches to chunks 
-        # (Since we normalized batch to list of list, we just iterate)
+    for source_index, source in enumerate(sources):
+        file_name = source["file_name"]
+        pages = source["pages"]
         
-        # NOTE: For RAG, we might want smaller chunks than batch size (4000). 
-        # But for now, let's index the 4000-char chunks as they are semantic enough.
-        
-        raw_chunks = [b[0] for b in batches if len(b) > 0 and isinstance(b[0], str)]
-        deck_id = state.get("deck_id", "default")
-        
-        # We assume source is unknown or passed in metadata? 
-        # For now simple index
-        rag_engine.index_content(raw_chunks, deck_id=deck_id, source_file="user_upload")
-        
-    return {"batches": batches}
+        # 1. Vision Mode (List of images)
+        if source["mode"] == "image":
+            BATCH_SIZE = 5
+            print(f"Vision Mode [{file_name}]: {len(pages)} pages. Batching by {BATCH_SIZE}...")
+            for i in range(0, len(pages), BATCH_SIZE):
+                batch_pages = pages[i:i + BATCH_SIZE]
+                batches.append({
+                    "batch_content": batch_pages,
+                    "mode": "image",
+                    "source_index": source_index,
+                    "source_file": file_name,
+                    "page_start": i + 1,
+                    "page_end": i + len(batch_pages)
+                })
+            
+        # 2. Text Mode (per-page strings)
+        else:
+            # Split the joined file text, then map each chunk's offsets back to pages.
+            page_offsets = []
+            offset = 0
+            for page_text in pages:
+                page_offsets.append(offset)
+                offset += len(page_text)
+            text = "".join(pages)
+            
+            docs = splitter.create_documents([text])
+            file_batches = []
+            for d in docs:
+                start = d.metadata.get("start_index", 0)
+                end = start + max(len(d.page_content) - 1, 0)
+                file_batches.append({
+                    "batch_content": [d.page_content],
+                    "mode": "text",
+                    "source_index": source_index,
+                    "source_file": file_name,
+                    "page_start": _page_for_offset(page_offsets, start),
+                    "page_end": _page_for_offset(page_offsets, end)
+                })
+            print(f"Text Mode [{file_name}]: {len(file_batches)} chunks.")
+            batches.extend(file_batches)
+            
+            # --- RAG INDEXING ---
+            # Text chunks are indexed straight away, per file, with their page ranges.
+            if rag_engine and file_batches:
+                rag_engine.index_content(
+                    [b["batch_content"][0] for b in file_batches],
+                    deck_id=deck_id,
+                    source_file=file_name,
+                    page_ranges=[(b["page_start"], b["page_end"]) for b in file_batches]
+                )
+
+    for i, b in enumerate(batches):
+        b["batch_id"] = i
+        b["deck_id"] = deck_id
+    sections = plan_sections(batches)
+
+    print(f"Created {len(batches)} batches/jobs across {len(sources)} files ({len(sections)} flowchart sections).")
+    return {"batches": batches, "sections": sections}
+
+def _attach_provenance(cards: List[Any], state: BatchInput) -> List[Dict]:
+    """
+    Stamps every generated card with the file and page range of its batch.
+    """
+    tagged = []
+    for c in cards:
+        if hasattr(c, 'model_dump'): c = c.model_dump()
+        elif hasattr(c, 'dict'): c = c.dict()
+        if not isinstance(c, dict):
+            continue
+        tagged.append({
+            **c,
+            "source_file": state.get("source_file"),
+            "page_start": state.get("page_start"),
+            "page_end": state.get("page_end"),
+            "batch_id": state.get("batch_id")
+        })
+    return tagged
 
 def generate_batch_node(state: BatchInput):
     """
     WORKER: Processes a single batch of images/text.
     """
     batch = state['batch_content']
-    print(f"--- WORKER: Processing Batch ({len(batch)} items) ---")
-    
-    generated = []
-    parser = JsonOutputParser(pydantic_object=CardList)
+    print(f"--- WORKER: Processing Batch ({len(batch)} items, {state.get('source_file')} "
+          f"p.{state.get('page_start')}-{state.get('page_end')}) ---")
     
-    # Check if this batch is Images (Vision) or Text
-    # Heuristic: check first item length/spaces
-    first_item = batch[0]
-    is_image = len(first_item) > 100 and " " not in first_item[:100]
+    # Mode comes from the chunker; fall back to the old heuristic for hand-built inputs.
+    mode = state.get("mode")
+    if not mode:
+        first_item = batch[0]
+        mode = "image" if len(first_item) > 100 and " " not in first_item[:100] else "text"
     
     try:
-        if is_image:
-            # Construct ONE Multimodal Message for the whole batch
-            content_parts = [
-                {"type": "text", "text": "Analyze these document slides/pages. Create 15-20 high-quality flashcards. Group them by TOPIC (e.g. 'Intro', 'Mechanism', 'Summary'). ALSO generate a Mermaid.js flowchart (graph TD) summarizing the visual flow. FINALLY, provide a detailed textual summary/transcription for RAG. Return valid JSON with 'cards' (each having q, a, topic), 'flowchart', and 'transcription'."}
-            ]
-            for img in batch:
-                content_parts.append({
-                    "type": "image_url", 
-                    "image_url": {"url": f"data:image/jpeg;base64,{img}"}
-                })
-                
-            msg = {"role": "user", "content": content_parts}
-            res = llm.invoke([msg])
-            
-        else:
-            # Text Batch (usually 1 large chunk)
-            text_blob = "\n\n".join(batch)
-            # Updated Prompt for Flowchart
-            prompt = ChatPromptTemplate.from_messages([
-                 ("system", "You are an expert tutor. Create 15-20 high-quality flashcards covering all topics. "
-                            "Group them by generic TOPICS. "
-                            "ALSO, identify the core process or hierarchy in the text and generate a Mermaid.js flowchart (graph TD) representing it. "
-                            "Return JSON with keys: 'cards' (list of {{q, a, topic}}) and 'flowchart' (string, optional)."),
-                 ("user", "{text}")
-             ])
-            chain = prompt | llm | parser
-            # We bypass chain invoke to handle manual parsing if needed, but chain is cleaner for text
-            res = chain.invoke({"text": text_blob})
-            # chain returns parsed dict usually
-            if isinstance(res, dict):
-                return {
-                    "partial_cards": res.get('cards', []), 
-                    "flowcharts": [res.get('flowchart')] if res.get('flowchart') else [],
-                    "transcriptions": [res.get('transcription')] if res.get('transcription') else []
-                }
-            elif isinstance(res, list):
-                 return {"partial_cards": res, "flowcharts": [], "transcriptions": []}
-            return {"partial_cards": [], "flowcharts": [], "transcriptions": []} # Fallback
-
-        if is_image:
-             # Manual Parse for Vision
-             try:
-                parsed = parser.parse(res.content)
-             except:
-                # Fallback if raw text
-                parsed = {} 
-
-             if isinstance(parsed, dict):
-                 generated = parsed.get('cards', [])
-                 flowchart = parsed.get('flowchart')
-                 transcription = parsed.get('transcription', "")
-             elif isinstance(parsed, list):
-                 generated = parsed
-                 flowchart = None
-                 transcription = ""
-         
-        # Add flowchart to output if present
-        return {
-            "partial_cards": generated, 
-            "flowcharts": [flowchart] if flowchart else [],
-            "transcriptions": [transcription] if transcription else []
-        }
+        res = generation_client.generate(batch, mode)
+        return {"partial_cards": _attach_provenance(res.get('cards', []), state)}
 
     except Exception as e:
         print(f"Error in generate_batch_node: {e}")
-        return {"partial_cards": [], "flowcharts": [], "transcriptions": []}
+        return {"partial_cards": []}
+
+def transcribe_batch_node(state: BatchInput):
+    """
+    WORKER: Transcribes one vision batch and indexes it right away,
+    so /chat can use the deck before card generation finishes.
+    """
+    print(f"--- TRANSCRIBER: {state.get('source_file')} p.{state.get('page_start')}-{state.get('page_end')} ---")
+    try:
+        text = generation_client.transcribe(state['batch_content'])
+        if text and rag_engine:
+            rag_engine.index_content(
+                [text],
+                state.get("deck_id", "default"),
+                state.get("source_file") or "Uploaded Document",
+                page_ranges=[(state.get("page_start"), state.get("page_end"))]
+            )
+        return {"transcribed_batches": 1 if text else 0}
+    except Exception as e:
+        print(f"Error in transcribe_batch_node: {e}")
+        return {"transcribed_batches": 0}
 
 def refine_deck(state: DeckState):
     print("--- NODE: REFINER (REDUCER) ---")
@@ -214,57 +317,96 @@ def refine_deck(state: DeckState):
         a = c.get('a') or c.get('A') or c.get('answer') or c.get('back')
         
         if q and isinstance(q, str):
-            unique_map[q.strip()] = {"q": q, "a": a}
+            unique_map[q.strip()] = {
+                "q": q,
+                "a": a,
+                "topic": c.get('topic'),
+                "source_file": c.get('source_file'),
+                "page_start": c.get('page_start'),
+                "page_end": c.get('page_end'),
+                "batch_id": c.get('batch_id')
+            }
             
     final = list(unique_map.values())
     
-    # Aggregate Flowcharts (Simple concatenation for now or pick longest)
-    # We just pass them through to final state or filter empty
-    flowcharts = state.get('flowcharts', [])
-    valid_charts = [f for f in flowcharts if f and isinstance(f, str) and "graph" in f]
-    
-    # Dedup flowcharts?
-    valid_charts = list(set(valid_charts))
+    # Text files were indexed by the chunker, vision files by the transcriber, as they arrived.
+    print(f"Refined {len(final)} cards ({state.get('transcribed_batches', 0)} vision batches transcribed).")
     
-    # --- RAG INDEXING ---
-    # We do this here to ensure we only index after successful generation
-    if rag_engine:
-        transcriptions = state.get('transcriptions', [])
-        deck_id = state.get('deck_id')
-        
-        content_to_index = []
-        if transcriptions and any(transcriptions):
-             # Vision Mode: Index the LLM-generated transcriptions
-             content_to_index = transcriptions
-        else:
-             # Text Mode: Index the original text
-             original = state.get('original_text')
-             if isinstance(original, str):
-                 content_to_index = [original] # Let PDR split it
-        
-        if content_to_index:
-            rag_engine.index_content(content_to_index, deck_id, "Uploaded Document")
+    # Persist in one bulk transaction so decks can be paged/exported without rerunning the graph
+    deck_store.save_cards(state.get('deck_id', "default"), final)
+
+    return {"final_cards": final}
+
+def generate_section_flowchart(state: SectionInput):
+    """
+    WORKER: One flowchart per document section, from that section's cards.
+    """
+    section = state['section']
+    print(f"--- FLOWCHART: section {section['index']} ({describe_section(section)}) ---")
+    try:
+        chart = generation_client.flowchart(state['cards'], max_cards=FLOWCHART_MAX_CARDS)
+    except Exception as e:
+        print(f"Error in generate_section_flowchart: {e}")
+        chart = None
+    return {"section_flowcharts": [{"section": section['index'], "chart": chart}] if chart else []}
 
-    return {"final_cards": final, "flowcharts": valid_charts}
+def merge_flowcharts(state: DeckState):
+    """
+    Orders section flowcharts by section (upload/page order) and drops duplicates.
+    """
+    print("--- NODE: FLOWCHART MERGER ---")
+    ordered = sorted(state.get('section_flowcharts', []), key=lambda f: f['section'])
+    charts = []
+    for f in ordered:
+        if f['chart'] not in charts:
+            charts.append(f['chart'])
+    charts = charts[:MAX_FLOWCHARTS]
+    deck_store.save_flowcharts(state.get('deck_id', "default"), charts)
+    return {"flowcharts": charts}
 
 # --- EDGE LOGIC ---
 
 def map_jobs(state: DeckState):
     # Retrieve batches created by chunker
     batches = state.get("batches", [])
-    # Create Send objects for parallel execution
-    return [Send("generator", {"batch_content": b}) for b in batches]
+    # Create Send objects for parallel execution (each batch keeps its file/page provenance)
+    jobs = [Send("generator", b) for b in batches]
+    if VISION_TRANSCRIPTION:
+        jobs += [Send("transcriber", b) for b in batches if b["mode"] == "image"]
+    return jobs
+
+def map_flowcharts(state: DeckState):
+    sections = state.get("sections", [])
+    if not FLOWCHART_STAGE or not sections:
+        return END
+    
+    cards_by_batch: Dict[int, List[Dict]] = {}
+    for c in state.get("final_cards", []):
+        cards_by_batch.setdefault(c.get("batch_id"), []).append(c)
+    
+    jobs = []
+    for section in sections:
+        cards = sample_section_cards(cards_by_batch, section["batch_ids"], FLOWCHART_MAX_CARDS)
+        if cards:
+            jobs.append(Send("flowcharter", {"section": section, "cards": cards}))
+    return jobs or END
 
 # --- GRAPH BUILD ---
 
 workflow = StateGraph(DeckState)
 workflow.add_node("chunker", chunk_document)
 workflow.add_node("generator", generate_batch_node)
+workflow.add_node("transcriber", transcribe_batch_node)
 workflow.add_node("refiner", refine_deck)
+workflow.add_node("flowcharter", generate_section_flowchart)
+workflow.add_node("flowchart_merger", merge_flowcharts)
 
 workflow.add_edge(START, "chunker")
-workflow.add_conditional_edges("chunker", map_jobs, ["generator"])
+workflow.add_conditional_edges("chunker", map_jobs, ["generator", "transcriber"])
 workflow.add_edge("generator", "refiner")
-workflow.add_edge("refiner", END)
+workflow.add_edge("transcriber", "refiner")
+workflow.add_conditional_edges("refiner", map_flowcharts, ["flowcharter", END])
+workflow.add_edge("flowcharter", "flowchart_merger")
+workflow.add_edge("flowchart_merger", END)
 
 app_graph = workflow.compile()
@@ -0,0 +1,96 @@
+"""
+Benchmark: deck store write throughput and read latency.
+
+Writes N cards (one big deck plus many small decks) into a throwaway SQLite file,
+then times deck lookups, keyset card pages at several depths, topic-filtered pages
+and a full ordered scan.
+
+Usage:
+    python bench_deck_store.py --cards 100000 --decks 200
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+import deck_store
+
+def synthetic_cards(n: int, prefix: str):
+    return [
+        {
+            "q": f"{prefix} question {i}: what happens at stage {i}?",
+            "a": f"Stage {i} converts the output of stage {i - 1} for stage {i + 1}.",
+            "topic": f"Topic {i % 40}",
+            "source_file": f"lecture_{i % 12}.pdf",
+            "page_start": i % 60 + 1,
+            "page_end": i % 60 + 2,
+        }
+        for i in range(n)
+    ]
+
+def timed(fn, repeats: int):
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append((time.perf_counter() - start) * 1000)
+    lat = np.array(latencies)
+    return np.percentile(lat, 50), np.percentile(lat, 99)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cards", type=int, default=100000, help="Cards in the big deck")
+    parser.add_argument("--decks", type=int, default=200, help="Extra small decks (500 cards each)")
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="flashdeck_store_")
+    deck_store.DB_PATH = os.path.join(workdir, "bench.db")
+    try:
+        # --- Writes ---
+        big = synthetic_cards(args.cards, "big")
+        deck_store.create_deck("big", "Big Deck")
+        start = time.perf_counter()
+        deck_store.save_cards("big", big)
+        elapsed = time.perf_counter() - start
+        print(f"Bulk write: {args.cards} cards in {elapsed:.2f}s ({args.cards / elapsed:,.0f} cards/s)")
+
+        small = synthetic_cards(500, "small")
+        start = time.perf_counter()
+        for d in range(args.decks):
+            deck_store.create_deck(f"deck-{d}", f"Deck {d}")
+            deck_store.save_cards(f"deck-{d}", small)
+            deck_store.save_flowcharts(f"deck-{d}", ["graph TD; A-->B"])
+            deck_store.finish_deck(f"deck-{d}")
+        elapsed = time.perf_counter() - start
+        total = args.decks * 500
+        print(f"Small decks: {args.decks} x 500 cards in {elapsed:.2f}s ({total / elapsed:,.0f} cards/s)")
+        print(f"DB size: {sum(os.path.getsize(os.path.join(workdir, f)) for f in os.listdir(workdir)) / 1e6:.1f} MB\n")
+
+        # --- Reads ---
+        mid = args.cards // 2
+        last = args.cards - 51
+        cases = [
+            ("get_deck", lambda: deck_store.get_deck("big")),
+            ("cards page 1", lambda: deck_store.get_cards("big", limit=50)),
+            (f"cards after {mid}", lambda: deck_store.get_cards("big", limit=50, after=mid)),
+            (f"cards after {last}", lambda: deck_store.get_cards("big", limit=50, after=last)),
+            ("topic page", lambda: deck_store.get_cards("big", limit=50, after=mid, topic="Topic 7")),
+            ("list_topics", lambda: deck_store.list_topics("big")),
+        ]
+        print(f"{'read':<24}{'p50 ms':>9}{'p99 ms':>9}")
+        for name, fn in cases:
+            p50, p99 = timed(fn, args.repeats)
+            print(f"{name:<24}{p50:>9.2f}{p99:>9.2f}")
+
+        start = time.perf_counter()
+        count = sum(1 for _ in deck_store.iter_cards("big"))
+        print(f"\nFull ordered scan: {count} cards in {time.perf_counter() - start:.2f}s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark: deck export time per format for large card sets.
+
+Usage:
+    python bench_export.py --cards 10000 50000
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from deck_builder import create_anki_deck, iter_export
+
+def synthetic_deck(n: int):
+    cards = [
+        {
+            "q": f"Question {i}: what does mechanism {i % 97} do in stage {i}?",
+            "a": f"It converts the output of stage {i} into the input of stage {i + 1}, keeping invariant {i % 13}.",
+            "topic": f"Topic {i % 25}",
+            "source_file": f"lecture_{i % 12}.pdf",
+            "page_start": i % 40 + 1,
+            "page_end": i % 40 + 2,
+        }
+        for i in range(n)
+    ]
+    return {"deck_id": f"bench-{n}", "deck_name": f"Bench_{n}", "cards": cards}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cards", type=int, nargs="+", default=[10000, 50000])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="flashdeck_export_")
+    try:
+        print(f"{'cards':>8}{'format':>8}{'seconds':>10}{'MB':>8}{'first chunk ms':>16}")
+        for n in args.cards:
+            deck = synthetic_deck(n)
+
+            start = time.perf_counter()
+            path = create_anki_deck(deck["cards"], deck_name=deck["deck_name"], deck_id=deck["deck_id"],
+                                    output_path=os.path.join(workdir, f"{n}.apkg"))
+            elapsed = time.perf_counter() - start
+            print(f"{n:>8}{'apkg':>8}{elapsed:>10.2f}{os.path.getsize(path) / 1e6:>8.1f}{'-':>16}")
+
+            for fmt in ("csv", "tsv", "json"):
+                start = time.perf_counter()
+                first = None
+                size = 0
+                for chunk in iter_export(deck, fmt):
+                    if first is None:
+                        first = (time.perf_counter() - start) * 1000
+                    size += len(chunk.encode("utf-8"))
+                elapsed = time.perf_counter() - start
+                print(f"{n:>8}{fmt:>8}{elapsed:>10.2f}{size / 1e6:>8.1f}{first:>16.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
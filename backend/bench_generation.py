@@ -0,0 +1,207 @@
+"""
+Benchmark: batch generation through GenerationClient vs the previous per-call prompt + free-text JSON path.
+
+Starts a local OpenAI-compatible mock server in its own process (no API key, no network; its CPU
+is not charged to the client). The mock behaves like a model that answers exactly what it is asked:
+it returns every key the request asks for (the response_format schema if there is one, otherwise the
+keys the prompt names), serialized identically for both paths, at a fixed token rate.
+Every Nth response is cut off mid-stream, and both paths get the same retry budget.
+
+What differs, and why:
+- The legacy prompt also asks for a Mermaid 'flowchart' in every batch; the client's CardList schema
+  is cards only (flowcharts are one call per section in their own stage). That is the output-token
+  and latency saving per batch.
+- A cut-off response is retried on both paths; the client also keeps the complete cards of the
+  cut attempt if the retry does worse.
+Reports per-batch latency, output tokens, requests, cards kept and lost batches.
+
+Usage:
+    python bench_generation.py --batches 40 --fail-every 5
+"""
+import os
+import json
+import time
+import socket
+import argparse
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+from langchain_openai import ChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import JsonOutputParser
+
+from agent_graph import CardList, Flashcard
+from generation_engine import GenerationClient
+
+ANSWERS = {
+    "cards": [
+        {"q": f"What does step {i} of the process do?", "a": f"Step {i} transforms the input for stage {i + 1}.", "topic": "Mechanism"}
+        for i in range(18)
+    ],
+    "flowchart": "graph TD; " + "; ".join(f"S{i}[Step {i}] --> S{i + 1}[Step {i + 1}]" for i in range(11)),
+}
+
+def requested_keys(body) -> list:
+    """
+    The keys a request asks for: the response_format schema's properties, or the quoted keys its prompt names.
+    """
+    response_format = body.get("response_format")
+    if response_format:
+        return list(response_format["json_schema"]["schema"]["properties"])
+    prompt = " ".join(m["content"] for m in body["messages"] if isinstance(m.get("content"), str))
+    return [key for key in ANSWERS if f"'{key}'" in prompt]
+
+def render(body) -> str:
+    # Same serialization for both paths: only what was asked for differs.
+    return json.dumps({key: ANSWERS[key] for key in requested_keys(body)}, separators=(",", ":"))
+
+class MockHandler(BaseHTTPRequestHandler):
+    fail_every = 0
+    token_delay = 0.0005
+    requests = 0
+    output_tokens = 0
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send_json(self, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.send_json({"requests": MockHandler.requests, "output_tokens": MockHandler.output_tokens})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path == "/reset":
+            MockHandler.requests = MockHandler.output_tokens = 0
+            return self.send_json({})
+
+        MockHandler.requests += 1 # One request at a time: the benchmark calls sequentially
+        n = MockHandler.requests
+        text = render(body)
+        cut = self.fail_every and n % self.fail_every == 0
+        tokens = [text[i:i + 4] for i in range(0, len(text), 4)] # ~4 chars per token
+        if cut:
+            tokens = tokens[:len(tokens) * 2 // 3]
+        MockHandler.output_tokens += len(tokens)
+        start = time.perf_counter()
+
+        if not body.get("stream"):
+            time.sleep(self.token_delay * len(tokens))
+            if cut:
+                self.send_response(500)
+                self.end_headers()
+                return
+            return self.send_json({
+                "id": f"mock-{n}", "object": "chat.completion", "model": body.get("model"),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i, tok in enumerate(tokens):
+            # Paced against a schedule, so the stream takes as long as the non-streamed response
+            time.sleep(max(start + (i + 1) * self.token_delay - time.perf_counter(), 0))
+            delta = {"role": "assistant", "content": tok} if i == 0 else {"content": tok}
+            chunk = {
+                "id": f"mock-{n}", "object": "chat.completion.chunk", "model": body.get("model"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None}]
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        if cut:
+            return # Drop the connection without [DONE]
+        self.wfile.write(b"data: [DONE]\n\n")
+
+def serve(fail_every: int, token_delay: float, ports):
+    MockHandler.fail_every = fail_every
+    MockHandler.token_delay = token_delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    ports.put(server.server_port)
+    server.serve_forever()
+
+def mock_call(base: str, path: str = "/stats") -> dict:
+    data = b"{}" if path == "/reset" else None
+    with urlopen(Request(base + path, data=data, headers={"Content-Type": "application/json"})) as res:
+        return json.loads(res.read())
+
+def legacy_generate(llm, text: str, max_attempts: int):
+    """
+    The previous text path: prompt rebuilt per call, free-text JSON, one parse at the end.
+    Given the same retry budget as GenerationClient (retry while nothing was parsed).
+    """
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", "You are an expert tutor. Create 15-20 high-quality flashcards covering all topics. "
+                   "Group them by generic TOPICS. "
+                   "ALSO, identify the core process or hierarchy in the text and generate a Mermaid.js flowchart (graph TD) representing it. "
+                   "Return JSON with keys: 'cards' (list of {{q, a, topic}}) and 'flowchart' (string, optional)."),
+        ("user", "{text}")
+    ])
+    chain = prompt | llm | JsonOutputParser(pydantic_object=CardList)
+    for _ in range(max_attempts):
+        try:
+            res = chain.invoke({"text": text})
+            cards = res.get("cards", []) if isinstance(res, dict) else []
+        except Exception:
+            cards = []
+        if cards:
+            return cards
+    return []
+
+def run(name, generate, batches, base):
+    mock_call(base, "/reset")
+    latencies, lost, cards = [], 0, 0
+    for text in batches:
+        start = time.perf_counter()
+        got = generate(text)
+        latencies.append((time.perf_counter() - start) * 1000)
+        lost += 0 if got else 1
+        cards += len(got)
+    stats = mock_call(base)
+    lat = np.array(latencies)
+    print(f"{name:<20}{np.mean(lat):>10.1f}{np.percentile(lat, 95):>10.1f}"
+          f"{stats['output_tokens'] / len(batches):>12.0f}{stats['requests']:>10}{cards:>8}{lost:>7}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batches", type=int, default=40)
+    parser.add_argument("--fail-every", type=int, default=5, help="Cut every Nth response mid-stream (0 = never)")
+    parser.add_argument("--token-delay-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    ports = ctx.Queue()
+    server = ctx.Process(target=serve, args=(args.fail_every, args.token_delay_ms / 1000, ports), daemon=True)
+    server.start()
+    base = f"http://127.0.0.1:{ports.get(timeout=30)}"
+
+    llm = ChatOpenAI(base_url=f"{base}/v1", api_key="mock", model="mock", max_retries=0)
+    client = GenerationClient(llm, CardList, Flashcard)
+    batches = [f"Chunk {i}: " + "The process has several steps. " * 100 for i in range(args.batches)]
+
+    print(f"{args.batches} text batches, every {args.fail_every or 'no'}th response cut mid-stream, "
+          f"{args.token_delay_ms} ms/token, up to {client.max_attempts} attempts per batch on both paths\n")
+    print(f"{'path':<20}{'mean ms':>10}{'p95 ms':>10}{'out tok/b':>12}{'requests':>10}{'cards':>8}{'lost':>7}")
+    try:
+        run("legacy", lambda t: legacy_generate(llm, t, client.max_attempts), batches, base)
+        run("GenerationClient", lambda t: client.generate([t], "text")["cards"], batches, base)
+    finally:
+        server.terminate()
+
+if __name__ == "__main__":
+    main()
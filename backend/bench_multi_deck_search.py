@@ -0,0 +1,98 @@
+"""
+Benchmark: cross-deck search latency as the number of selected decks grows.
+
+Builds a throwaway index of synthetic decks (hash-seeded fake embeddings, no API key needed)
+and compares grouped concurrent fan-out with one sequential query per deck.
+
+Usage:
+    python bench_multi_deck_search.py --decks 300 --parents 5 --queries 30
+"""
+import os
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+from langchain_core.embeddings import Embeddings
+
+import rag_engine
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic stand-in for OpenAIEmbeddings: a unit vector seeded by the text.
+    """
+    def _vector(self, text: str) -> List[float]:
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+        v = np.random.default_rng(seed).standard_normal(rag_engine.FULL_EMBEDDING_DIMS)
+        return (v / np.linalg.norm(v)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text)
+
+def build_index(decks: int, parents: int) -> List[str]:
+    deck_ids = [f"deck-{d}" for d in range(decks)]
+    for deck_id in deck_ids:
+        pages = [
+            " ".join(f"{deck_id} page {p} sentence {s} about topic {(p * s) % 17}." for s in range(25))
+            for p in range(parents)
+        ]
+        rag_engine.index_content(pages, deck_id, f"{deck_id}.pdf")
+    return deck_ids
+
+def measure(deck_ids: List[str], queries: int, budget_ms: int):
+    latencies, timed_out = [], 0
+    for q in range(queries):
+        start = time.perf_counter()
+        res = rag_engine.search_decks(f"what is topic {q % 17}?", deck_ids, limit=10, budget_ms=budget_ms)
+        latencies.append((time.perf_counter() - start) * 1000)
+        timed_out += len(res["timed_out_decks"])
+    lat = np.array(latencies)
+    return np.percentile(lat, 50), np.percentile(lat, 95), np.percentile(lat, 99), timed_out
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--decks", type=int, default=300)
+    parser.add_argument("--parents", type=int, default=5, help="Parent pages per deck")
+    parser.add_argument("--queries", type=int, default=30)
+    parser.add_argument("--budget-ms", type=int, default=2000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="flashdeck_search_")
+    rag_engine.CHROMA_DIR = os.path.join(workdir, "chroma")
+    rag_engine.DOC_STORE_DIR = os.path.join(workdir, "docs")
+    rag_engine.FULL_VECTOR_DIR = os.path.join(workdir, "vectors")
+    rag_engine.get_full_embeddings = HashEmbeddings
+    try:
+        print(f"Indexing {args.decks} decks x {args.parents} pages...")
+        all_decks = build_index(args.decks, args.parents)
+
+        concurrent = rag_engine.search_executor
+        grouped = (f"groups of {rag_engine.SEARCH_GROUP_SIZE}", concurrent, rag_engine.SEARCH_GROUP_SIZE)
+        per_deck = ("per deck, seq", ThreadPoolExecutor(max_workers=1), 1)
+        measure(all_decks[:10], 3, args.budget_ms) # Warm up
+        print(f"\n{'decks':>6}{'fan-out':>16}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'timed out':>11}")
+        for n in sorted({10, 100, args.decks}):
+            if n > args.decks:
+                continue
+            for name, executor, group_size in (grouped, per_deck):
+                rag_engine.search_executor = executor
+                rag_engine.SEARCH_GROUP_SIZE = group_size
+                p50, p95, p99, timed_out = measure(all_decks[:n], args.queries, args.budget_ms)
+                print(f"{n:>6}{name:>16}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{timed_out:>11}")
+        rag_engine.search_executor = concurrent
+        rag_engine.SEARCH_GROUP_SIZE = grouped[2]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark: compact child-vector storage vs the current full float32 index.
+
+Runs offline on synthetic Matryoshka-style embeddings (energy concentrated in the
+leading dimensions, like text-embedding-3-small) so no API key is needed.
+Reports index size on disk, query latency and recall@k against exact full-precision search.
+
+Usage:
+    python bench_vector_storage.py --docs 20000 --queries 200 --k 4
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+
+os.environ.setdefault("OPENROUTER_API_KEY", "bench")
+
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_classic.storage import LocalFileStore
+
+from rag_engine import (
+    FULL_EMBEDDING_DIMS,
+    CompactEmbeddings,
+    truncate_embedding,
+    rerank_candidates,
+)
+
+class LookupEmbeddings(Embeddings):
+    """
+    Stand-in for OpenAIEmbeddings: returns the precomputed vector for each synthetic text.
+    """
+    def __init__(self, vectors: Dict[str, np.ndarray]):
+        self.vectors = vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.vectors[t].tolist() for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.vectors[text].tolist()
+
+def synthetic_vectors(n: int, dims: int, rng) -> np.ndarray:
+    # Decaying per-dimension scale mimics Matryoshka training.
+    scale = 1.0 / np.sqrt(1.0 + np.arange(dims) / 64.0)
+    v = rng.standard_normal((n, dims)).astype(np.float32) * scale
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+def run_config(name, dims, rerank, doc_texts, query_texts, lookup, truth, k, factor, workdir):
+    persist_dir = os.path.join(workdir, name, "chroma")
+    vector_dir = os.path.join(workdir, name, "vectors")
+    full_vector_store = LocalFileStore(vector_dir) if rerank else None
+
+    if dims >= FULL_EMBEDDING_DIMS:
+        embeddings = lookup
+    else:
+        embeddings = CompactEmbeddings(lookup, dims, full_vector_store=full_vector_store)
+
+    vs = Chroma(collection_name="bench", embedding_function=embeddings, persist_directory=persist_dir)
+    start = time.perf_counter()
+    for i in range(0, len(doc_texts), 1000):
+        batch = doc_texts[i:i + 1000]
+        vs.add_documents([Document(page_content=t) for t in batch], ids=batch)
+    index_s = time.perf_counter() - start
+
+    latencies = []
+    hits = 0
+    for q, expected in zip(query_texts, truth):
+        start = time.perf_counter()
+        full_query = lookup.vectors[q]
+        query_vec = truncate_embedding(full_query, dims) if dims < FULL_EMBEDDING_DIMS else full_query.tolist()
+        if rerank:
+            candidates = vs.similarity_search_by_vector(query_vec, k=k * factor)
+            results = rerank_candidates(full_query, candidates, full_vector_store)[:k]
+        else:
+            results = vs.similarity_search_by_vector(query_vec, k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len({d.page_content for d in results} & expected)
+
+    lat = np.array(latencies)
+    return {
+        "config": name,
+        "index_mb": dir_size(persist_dir) / 1e6,
+        "sidecar_mb": dir_size(vector_dir) / 1e6 if rerank else 0.0,
+        "index_s": index_s,
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p95_ms": float(np.percentile(lat, 95)),
+        "recall": hits / (k * len(query_texts)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--factor", type=int, default=4, help="Re-rank candidate multiplier")
+    parser.add_argument("--dims", type=int, nargs="+", default=[512, 256])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    docs = synthetic_vectors(args.docs, FULL_EMBEDDING_DIMS, rng)
+    targets = rng.integers(0, args.docs, args.queries)
+    queries = docs[targets] + 0.08 * synthetic_vectors(args.queries, FULL_EMBEDDING_DIMS, rng)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    doc_texts = [f"doc-{i}" for i in range(args.docs)]
+    query_texts = [f"query-{j}" for j in range(args.queries)]
+    lookup = LookupEmbeddings({**dict(zip(doc_texts, docs)), **dict(zip(query_texts, queries))})
+
+    # Ground truth: exact cosine over full float32 vectors.
+    top = np.argsort(-(queries @ docs.T), axis=1)[:, :args.k]
+    truth = [{doc_texts[i] for i in row} for row in top]
+
+    configs = [("full-1536", FULL_EMBEDDING_DIMS, False)]
+    for d in args.dims:
+        configs.append((f"compact-{d}", d, False))
+        configs.append((f"compact-{d}+rerank", d, True))
+
+    workdir = tempfile.mkdtemp(prefix="flashdeck_bench_")
+    try:
+        print(f"{args.docs} child vectors, {args.queries} queries, recall@{args.k}\n")
+        print(f"{'config':<22}{'index MB':>10}{'sidecar MB':>12}{'build s':>10}{'p50 ms':>9}{'p95 ms':>9}{'recall':>8}")
+        for name, dims, rerank in configs:
+            r = run_config(name, dims, rerank, doc_texts, query_texts, lookup, truth, args.k, args.factor, workdir)
+            print(f"{r['config']:<22}{r['index_mb']:>10.1f}{r['sidecar_mb']:>12.1f}{r['index_s']:>10.1f}"
+                  f"{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['recall']:>8.3f}")
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
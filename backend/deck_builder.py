@@ -1,39 +1,134 @@
+import os
+import csv
+import io
+import json
+import hashlib
+import tempfile
+from typing import Dict, Iterable, Iterator, Optional
+
 import genanki
-import random
 
-def create_anki_deck(cards_data, deck_name="FlashDeck"):
-    # 1. Generate Unique ID
-    deck_id = random.randrange(1 << 30, 1 << 31)
-    
+# --- CONFIG ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORT_DIR = os.path.join(BASE_DIR, "exports") # Per-download .apkg files, deleted once sent
+
+EXPORT_FORMATS = {
+    "apkg": "application/octet-stream",
+    "csv": "text/csv",
+    "tsv": "text/tab-separated-values",
+    "json": "application/json",
+}
+EXPORT_FIELDS = ["q", "a", "topic", "source_file", "page_start", "page_end"]
+ROWS_PER_CHUNK = 500 # Rows per streamed chunk for CSV/TSV
+
+# Model (Card Style) is shared by every deck: its id must never change, or Anki sees a new note type.
+FLASHDECK_MODEL = genanki.Model(
+    1607392319,
+    'Simple Model',
+    fields=[
+        {'name': 'Question'},
+        {'name': 'Answer'},
+    ],
+    templates=[
+        {
+            'name': 'Card 1',
+            'qfmt': '{{Question}}',
+            'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}',
+        },
+    ])
+
+def stable_anki_id(key: str) -> int:
+    """
+    Derives a deterministic Anki deck id in genanki's recommended range [2^30, 2^31).
+    """
+    digest = int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16)
+    return (1 << 30) + digest % (1 << 30)
+
+def note_guid(deck_id: str, card: Dict) -> str:
+    """
+    Stable note GUID from the deck and the card's question.
+    Re-importing the same deck updates these notes in place (edited answers included).
+    """
+    return genanki.guid_for(deck_id, (card.get('q') or "").strip())
+
+def create_anki_deck(cards_data, deck_name="FlashDeck", deck_id: Optional[str] = None,
+                     output_path: Optional[str] = None):
+    # 1. Stable ID (falls back to the deck name for callers without a deck_id)
+    key = deck_id or deck_name
+
     # 2. Create Deck
-    my_deck = genanki.Deck(deck_id, f"FlashDeck - {deck_name}")
-    
-    # 3. Define Model (Card Style)
-    my_model = genanki.Model(
-        1607392319,
-        'Simple Model',
-        fields=[
-            {'name': 'Question'},
-            {'name': 'Answer'},
-        ],
-        templates=[
-            {
-                'name': 'Card 1',
-                'qfmt': '{{Question}}',
-                'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}',
-            },
-        ])
-
-    # 4. Add Cards
+    my_deck = genanki.Deck(stable_anki_id(key), f"FlashDeck - {deck_name}")
+
+    # 3. Add Cards
     for card in cards_data:
         note = genanki.Note(
-            model=my_model,
-            fields=[card['q'], card['a']]
+            model=FLASHDECK_MODEL,
+            fields=[card['q'], card['a'] or ""],
+            guid=note_guid(key, card)
         )
         my_deck.add_note(note)
 
-    # 5. Save
-    output_filename = "flashdeck_generated.apkg"
-    genanki.Package(my_deck).write_to_file(output_filename)
-    
-    return output_filename
+    # 4. Save (a fresh file the caller deletes, unless it picks the path), via a temp file + rename
+    #    so a reader never sees a half-written package
+    if output_path is None:
+        output_path = new_export_path(key)
+    fd, tmp_path = tempfile.mkstemp(suffix=".apkg.tmp", dir=os.path.dirname(os.path.abspath(output_path)))
+    os.close(fd)
+    try:
+        genanki.Package(my_deck).write_to_file(tmp_path)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return output_path
+
+def new_export_path(deck_id: str) -> str:
+    """
+    A fresh, unique .apkg path for one download; the caller deletes it once it has been sent.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=f"{deck_id}-", suffix=".apkg", dir=EXPORT_DIR)
+    os.close(fd)
+    return path
+
+# --- STREAMING EXPORTS ---
+
+def iter_delimited(cards: Iterable[Dict], delimiter: str = ",") -> Iterator[str]:
+    """
+    Yields CSV/TSV text in chunks of ROWS_PER_CHUNK rows, header first.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, delimiter=delimiter, extrasaction="ignore")
+    writer.writeheader()
+    for i, card in enumerate(cards, 1):
+        writer.writerow(card)
+        if i % ROWS_PER_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def iter_json(deck: Dict) -> Iterator[str]:
+    """
+    Yields the deck as one JSON document, one card per chunk.
+    """
+    yield json.dumps({"deck_id": deck["deck_id"], "deck_name": deck["deck_name"]}, ensure_ascii=False)[:-1]
+    yield ', "cards": ['
+    for i, card in enumerate(deck["cards"]):
+        card = {field: card.get(field) for field in EXPORT_FIELDS}
+        yield ("," if i else "") + json.dumps(card, ensure_ascii=False)
+    yield "]}"
+
+def iter_export(deck: Dict, fmt: str) -> Iterator[str]:
+    """
+    Streaming exporter for the text formats (csv, tsv, json).
+    """
+    if fmt == "csv":
+        return iter_delimited(deck["cards"], ",")
+    if fmt == "tsv":
+        return iter_delimited(deck["cards"], "\t")
+    if fmt == "json":
+        return iter_json(deck)
+    raise ValueError(f"Unsupported streaming export format: {fmt}")
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+# --- CONFIG ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.getenv("FLASHDECK_DB", os.path.join(BASE_DIR, "flashdeck.db"))
+ITER_CHUNK = 1000 # Rows fetched per round trip when streaming a whole deck
+
+CARD_FIELDS = ["q", "a", "topic", "source_file", "page_start", "page_end"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS decks (
+    deck_id TEXT PRIMARY KEY,
+    deck_name TEXT NOT NULL,
+    status TEXT NOT NULL,          -- processing | ready | failed
+    files TEXT,                    -- JSON list of {file_name, mode, pages}
+    card_count INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS cards (
+    deck_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    q TEXT NOT NULL,
+    a TEXT,
+    topic TEXT,
+    source_file TEXT,
+    page_start INTEGER,
+    page_end INTEGER,
+    PRIMARY KEY (deck_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_cards_topic ON cards (deck_id, topic, position);
+CREATE TABLE IF NOT EXISTS flowcharts (
+    deck_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    chart TEXT NOT NULL,
+    PRIMARY KEY (deck_id, position)
+) WITHOUT ROWID;
+"""
+
+_initialized = set()
+
+class DeckExistsError(Exception):
+    """
+    Raised by create_deck when the deck_id is already taken.
+    """
+
+@contextmanager
+def _connect():
+    """
+    One short-lived connection per call: safe from FastAPI's worker threads and graph workers.
+    WAL lets readers page through cards while a deck is being written.
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        if DB_PATH not in _initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            _initialized.add(DB_PATH)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn: # One transaction per call
+            yield conn
+    finally:
+        conn.close()
+
+def _ensure_deck(conn, deck_id: str):
+    conn.execute(
+        "INSERT OR IGNORE INTO decks (deck_id, deck_name, status, created_at) VALUES (?, ?, 'processing', ?)",
+        (deck_id, f"FlashDeck_{deck_id[:8]}", time.time())
+    )
+
+# --- WRITES ---
+
+def create_deck(deck_id: str, deck_name: str, files: Optional[List[Dict]] = None):
+    """
+    Registers a generation job before the graph runs.
+    Never overwrites: raises DeckExistsError if the deck_id is taken.
+    """
+    try:
+        with _connect() as conn:
+            conn.execute(
+                "INSERT INTO decks (deck_id, deck_name, status, files, created_at) VALUES (?, ?, 'processing', ?, ?)",
+                (deck_id, deck_name, json.dumps(files or []), time.time())
+            )
+    except sqlite3.IntegrityError:
+        raise DeckExistsError(deck_id)
+
+def set_deck_files(deck_id: str, files: List[Dict]):
+    with _connect() as conn:
+        conn.execute("UPDATE decks SET files = ? WHERE deck_id = ?", (json.dumps(files), deck_id))
+
+def finish_deck(deck_id: str, status: str = "ready", error: Optional[str] = None):
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE decks SET status = ?, error = ?, finished_at = ? WHERE deck_id = ?",
+            (status, error, time.time(), deck_id)
+        )
+
+def save_cards(deck_id: str, cards: List[Dict]):
+    """
+    Replaces a deck's cards in one bulk transaction.
+    """
+    rows = [
+        (deck_id, i, c.get("q") or "", c.get("a"), c.get("topic"),
+         c.get("source_file"), c.get("page_start"), c.get("page_end"))
+        for i, c in enumerate(cards)
+    ]
+    with _connect() as conn:
+        _ensure_deck(conn, deck_id)
+        conn.execute("DELETE FROM cards WHERE deck_id = ?", (deck_id,))
+        conn.executemany(
+            "INSERT INTO cards (deck_id, position, q, a, topic, source_file, page_start, page_end) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        conn.execute("UPDATE decks SET card_count = ? WHERE deck_id = ?", (len(rows), deck_id))
+
+def save_flowcharts(deck_id: str, charts: List[str]):
+    with _connect() as conn:
+        _ensure_deck(conn, deck_id)
+        conn.execute("DELETE FROM flowcharts WHERE deck_id = ?", (deck_id,))
+        conn.executemany(
+            "INSERT INTO flowcharts (deck_id, position, chart) VALUES (?, ?, ?)",
+            [(deck_id, i, chart) for i, chart in enumerate(charts)]
+        )
+
+# --- READS ---
+
+def get_deck(deck_id: str) -> Optional[Dict]:
+    """
+    Deck metadata, job status and flowcharts (not the cards).
+    """
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM decks WHERE deck_id = ?", (deck_id,)).fetchone()
+        if row is None:
+            return None
+        charts = conn.execute(
+            "SELECT chart FROM flowcharts WHERE deck_id = ? ORDER BY position", (deck_id,)
+        ).fetchall()
+    deck = dict(row)
+    deck["files"] = json.loads(deck["files"] or "[]")
+    deck["flowcharts"] = [r["chart"] for r in charts]
+    return deck
+
+def deck_exists(deck_id: str) -> bool:
+    with _connect() as conn:
+        return conn.execute("SELECT 1 FROM decks WHERE deck_id = ?", (deck_id,)).fetchone() is not None
+
+def get_cards(deck_id: str, limit: int = 50, after: int = -1, topic: Optional[str] = None) -> Dict:
+    """
+    One page of cards in deck order. Keyset pagination: pass the returned 'next_after' as 'after'.
+    """
+    query = "SELECT position, " + ", ".join(CARD_FIELDS) + " FROM cards WHERE deck_id = ? AND position > ?"
+    params = [deck_id, after]
+    if topic is not None:
+        query += " AND topic = ?"
+        params.append(topic)
+    query += " ORDER BY position LIMIT ?"
+    params.append(limit + 1) # One extra row tells us whether there is a next page
+
+    with _connect() as conn:
+        rows = conn.execute(query, params).fetchall()
+    page = [dict(r) for r in rows[:limit]]
+    return {
+        "cards": page,
+        "next_after": page[-1]["position"] if len(rows) > limit else None
+    }
+
+def iter_cards(deck_id: str) -> Iterator[Dict]:
+    """
+    Streams every card of a deck in order, ITER_CHUNK rows at a time.
+    """
+    after = -1
+    while True:
+        page = get_cards(deck_id, limit=ITER_CHUNK, after=after)
+        for card in page["cards"]:
+            card.pop("position")
+            yield card
+        if page["next_after"] is None:
+            return
+        after = page["next_after"]
+
+def list_topics(deck_id: str) -> List[Dict]:
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT topic, COUNT(*) AS cards FROM cards WHERE deck_id = ? GROUP BY topic ORDER BY MIN(position)",
+            (deck_id,)
+        ).fetchall()
+    return [dict(r) for r in rows]
@@ -0,0 +1,220 @@
+import json
+from typing import Any, Dict, List, Optional, Type
+
+from langchain_core.messages import SystemMessage, HumanMessage
+from langchain_core.utils.json import parse_json_markdown
+from langchain_core.utils.function_calling import convert_to_openai_function
+from pydantic import BaseModel, ValidationError
+
+# --- PROMPTS ---
+# Kept as module constants so every batch sends a byte-identical prefix
+# (system message first, batch content last) and provider prompt caches can hit.
+
+CARD_INSTRUCTIONS = (
+    "You are an expert tutor creating Anki flashcards. "
+    "Create 15-20 high-quality flashcards covering all topics. "
+    "Group them by generic TOPICS (e.g. 'Intro', 'Mechanism', 'Summary'). "
+    "Respond only with JSON matching the CardList schema: 'cards' (list of {q, a, topic})."
+)
+
+TEXT_SYSTEM_PROMPT = CARD_INSTRUCTIONS
+
+VISION_SYSTEM_PROMPT = CARD_INSTRUCTIONS + " The input is a batch of document slides/pages."
+
+# Flowcharts and transcriptions are separate stages with their own (smaller) outputs.
+FLOWCHART_SYSTEM_PROMPT = (
+    "You summarize one section of a study document as a Mermaid.js flowchart. "
+    "You are given the section's flashcards (topic, question, answer). "
+    "Identify the core process or hierarchy and return ONLY Mermaid code starting with 'graph TD', "
+    "at most 12 nodes, no explanations."
+)
+
+TRANSCRIPTION_SYSTEM_PROMPT = (
+    "Transcribe these document slides/pages into a detailed plain-text summary for search. "
+    "Keep headings, definitions, formulas and the content of diagrams. Return only the text."
+)
+
+def build_response_format(schema: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    OpenAI-style strict json_schema response_format for a pydantic model.
+    """
+    function = convert_to_openai_function(schema, strict=True)
+    json_schema = {"name": function["name"], "schema": function["parameters"], "strict": True}
+    if function.get("description"):
+        json_schema["description"] = function["description"]
+    return {"type": "json_schema", "json_schema": json_schema}
+
+class CardStreamParser:
+    """
+    Incremental scanner for a streamed card response ({"cards": [...]} or a bare list, fences allowed).
+    Each chunk is scanned once (string/escape state and nesting depth carry over between chunks),
+    and every card object is decoded as soon as its closing brace arrives.
+    A card whose object never closed is never returned.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.card_depth = None # Depth inside a card object: 3 under {"cards": [...]}, 2 under a bare list
+        self.in_string = False
+        self.escape = False
+        self.current = None # Characters of the card being read
+        self.cards = []
+
+    def feed(self, text: str) -> List[Any]:
+        new = []
+        for ch in text:
+            if self.current is not None:
+                self.current.append(ch)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            if self.depth == 0 and ch not in "{[":
+                continue # Prose or fences around the JSON
+            if ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                if self.depth == 0:
+                    self.card_depth = 3 if ch == "{" else 2
+                self.depth += 1
+                if ch == "{" and self.depth == self.card_depth:
+                    self.current = [ch]
+            elif ch in "}]":
+                if ch == "}" and self.depth == self.card_depth and self.current is not None:
+                    try:
+                        new.append(json.loads("".join(self.current)))
+                    except ValueError:
+                        pass
+                    self.current = None
+                self.depth = max(self.depth - 1, 0)
+        self.cards.extend(new)
+        return new
+
+class GenerationClient:
+    """
+    Batch generator with a stable prompt prefix, schema-constrained output and streamed responses.
+    Built once per process; every batch reuses the same bound model.
+    """
+    def __init__(self, llm, schema: Type[BaseModel], item_schema: Type[BaseModel], max_attempts: int = 3):
+        self.schema = schema
+        self.item_schema = item_schema
+        self.max_attempts = max_attempts
+        self.llm = llm.bind(response_format=build_response_format(schema))
+        self.plain_llm = llm
+        self.system_messages = {
+            "text": SystemMessage(content=TEXT_SYSTEM_PROMPT),
+            "image": SystemMessage(content=VISION_SYSTEM_PROMPT),
+            "flowchart": SystemMessage(content=FLOWCHART_SYSTEM_PROMPT),
+            "transcription": SystemMessage(content=TRANSCRIPTION_SYSTEM_PROMPT)
+        }
+
+    def build_messages(self, batch: List[str], mode: str) -> List[Any]:
+        if mode == "image":
+            content = [
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img}"}}
+                for img in batch
+            ]
+        else:
+            content = "\n\n".join(batch)
+        return [self.system_messages[mode], HumanMessage(content=content)]
+
+    def _validate(self, text: str) -> Optional[Dict]:
+        """
+        Full-schema validation of a complete response; None if it isn't valid JSON for the schema.
+        """
+        if not text.strip():
+            return None
+        try:
+            parsed = parse_json_markdown(text, parser=json.loads) # Strict: the default parser accepts truncated JSON
+            if isinstance(parsed, list):
+                parsed = {"cards": parsed}
+            return self.schema.model_validate(parsed).model_dump()
+        except Exception:
+            return None
+
+    def _salvage(self, raw_cards: List[Any]) -> Dict:
+        """
+        Keeps every closed card object that passes item validation.
+        """
+        cards = []
+        for c in raw_cards:
+            try:
+                cards.append(self.item_schema.model_validate(c).model_dump())
+            except ValidationError:
+                continue
+        return {"cards": cards}
+
+    def generate(self, batch: List[str], mode: str) -> Dict:
+        """
+        Streams one batch; card objects are decoded as they close, so a cut-off stream keeps
+        its complete cards without re-parsing the buffer.
+        A complete, schema-valid response is returned as-is (even with no cards).
+        A cut-off or invalid response is retried at least once; the attempt with the most
+        valid cards wins, and attempts continue until one has cards or max_attempts is reached.
+        """
+        messages = self.build_messages(batch, mode)
+        best = {"cards": []}
+
+        for attempt in range(1, self.max_attempts + 1):
+            chunks = []
+            parser = CardStreamParser()
+            complete = False
+            try:
+                for chunk in self.llm.stream(messages):
+                    if isinstance(chunk.content, str):
+                        chunks.append(chunk.content)
+                        parser.feed(chunk.content)
+                complete = True
+            except Exception as e:
+                print(f"Generation attempt {attempt}/{self.max_attempts} interrupted: {e}")
+
+            if complete:
+                result = self._validate("".join(chunks))
+                if result is not None:
+                    return result if len(result["cards"]) >= len(best["cards"]) else best
+                # Also reached when the connection drops without an error (no [DONE])
+                print(f"Generation attempt {attempt}/{self.max_attempts} returned incomplete or invalid JSON.")
+
+            result = self._salvage(parser.cards)
+            if len(result["cards"]) > len(best["cards"]):
+                best = result
+            if best["cards"] and attempt >= 2:
+                return best
+
+        if not best["cards"]:
+            print(f"Generation gave up after {self.max_attempts} attempts with no cards.")
+        return best
+
+    def flowchart(self, cards: List[Dict], max_cards: int = 40) -> Optional[str]:
+        """
+        One Mermaid flowchart for a document section, built from that section's cards.
+        """
+        if not cards:
+            return None
+        lines = [f"[{c.get('topic') or 'General'}] Q: {c.get('q')} A: {c.get('a')}" for c in cards[:max_cards]]
+        res = self.plain_llm.invoke([self.system_messages["flowchart"], HumanMessage(content="\n".join(lines))])
+        return clean_mermaid(res.content if isinstance(res.content, str) else "")
+
+    def transcribe(self, batch: List[str]) -> str:
+        """
+        Plain-text transcription of a batch of page images, for RAG indexing.
+        """
+        content = [
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img}"}}
+            for img in batch
+        ]
+        res = self.plain_llm.invoke([self.system_messages["transcription"], HumanMessage(content=content)])
+        return res.content.strip() if isinstance(res.content, str) else ""
+
+def clean_mermaid(text: str) -> Optional[str]:
+    """
+    Strips markdown fences/prose around a Mermaid chart; None if there is no graph in it.
+    """
+    text = text.replace("```mermaid", "").replace("```", "").strip()
+    start = text.find("graph")
+    if start == -1:
+        return None
+    return text[start:].strip()
@@ -1,16 +1,20 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Request
-from fastapi.responses import JSONResponse
-from typing import List, Optional
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Body, Request
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 from typing import List, Optional
 from pydantic import BaseModel
 import uuid
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from rag_engine import query_vector_db
+from rag_engine import query_vector_db, search_decks, deck_indexed
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 
-from deck_builder import create_anki_deck
+from deck_builder import create_anki_deck, new_export_path, iter_export, EXPORT_FORMATS
+import deck_store
 import shutil
 import os
 
@@ -54,84 +58,94 @@ async def global_exception_handler(request: Request, exc: Exception):
     )
 
 @app.post("/generate")
-async def generate_deck(files: List[UploadFile] = File(...)):
+async def generate_deck(files: List[UploadFile] = File(...), deck_id: Optional[str] = Form(None)):
+    # A client-chosen deck_id lets the frontend /chat on the deck while it is still generating
+    # (text is indexed up front, vision transcriptions batch by batch).
     print(f"📄 Processing {len(files)} files...")
-    deck_id = str(uuid.uuid4())
+    if deck_id:
+        try:
+            deck_id = str(uuid.UUID(deck_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="deck_id must be a UUID")
+    else:
+        deck_id = str(uuid.uuid4())
+    deck_name = f"FlashDeck_{deck_id[:8]}"
     
+    # Claim the deck_id before any work: an existing deck is never overwritten
     try:
-        # 1. Analyze Documents
-        from vision_engine import process_pdf
+        await run_in_threadpool(deck_store.create_deck, deck_id, deck_name)
+    except deck_store.DeckExistsError:
+        raise HTTPException(status_code=409, detail=f"Deck already exists: {deck_id}")
+    
+    try:
+        # 1. Analyze Documents (in parallel, in worker processes: PyMuPDF is not thread-safe)
+        from vision_engine import process_pdf, get_extract_pool, reset_extract_pool
+        loop = asyncio.get_running_loop()
         
-        all_content = []
-        is_vision_mode = False
+        async def run_extraction(data: bytes):
+            # A dead worker breaks the whole pool (possibly while parsing another upload):
+            # replace the pool and retry once, so only a file that crashes it twice fails.
+            for attempt in range(2):
+                pool = get_extract_pool()
+                try:
+                    return await loop.run_in_executor(pool, process_pdf, data)
+                except BrokenProcessPool:
+                    reset_extract_pool(pool)
+                    if attempt:
+                        raise
         
-        for file in files:
+        async def extract(file: UploadFile):
             await file.seek(0)
             try:
-                result_payload = process_pdf(file.file)
-                content = result_payload["content"]
-                mode = result_payload["mode"]
-                
-                if mode == "image":
-                    is_vision_mode = True
-                    # If any file is vision, we might treat all as vision or mix.
-                    # Current Graph expects explicit mode. 
-                    # If we mix, we should probably normalize to text if possible, or list of images.
-                    # For simplicty: If Vision mode, we extend list of images.
-                    # If text mode, we extend list of text strings?
-                    if isinstance(content, list): 
-                        all_content.extend(content)
-                    else:
-                        # Convert text to image? No.
-                        # Conflict handling:
-                        print("Warning: Mixed content types not fully supported. Treating as text if mixed.")
-                else:
-                    # Text Mode
-                    if isinstance(content, str):
-                        all_content.append(content)
-                
+                data = await file.read()
+                result_payload = await run_extraction(data)
             except Exception as e:
                 print(f"Processing Error {file.filename}: {e}")
-                # We continue with other files? Or fail?
                 # Fail for now to be safe
                 raise HTTPException(status_code=400, detail=f"File Read Failed: {file.filename} - {e}")
-
-        # Normalize content for Graph
-        # If is_vision_mode, all_content should be list of b64.
-        # If text mode, all_content is List[str].
-        # But Graph expects `original_text` as Union[str, List[str]].
-        # If it's a List[str] (Text Mode), the chunker handles it?
-        # Let's see agent_graph.py:88: text = str(content) -> join list?
-        
-        final_input_content = all_content
-        if not is_vision_mode:
-            # Join text modules with newlines
-            final_input_content = "\n\n".join(all_content)
-            
-        print(f"Combined Content Size: {len(final_input_content)} chars/images.")
+            return {
+                "file_name": file.filename or "Uploaded Document",
+                "mode": result_payload["mode"],
+                "pages": result_payload["pages"]
+            }
+        
+        sources = await asyncio.gather(*(extract(f) for f in files))
+        
+        for source in sources:
+            print(f"  - {source['file_name']}: {len(source['pages'])} pages ({source['mode']} mode)")
+        
+        files_meta = [{"file_name": src["file_name"], "mode": src["mode"], "pages": len(src["pages"])} for src in sources]
+        await run_in_threadpool(deck_store.set_deck_files, deck_id, files_meta)
 
         # 2. Run Multi-Agent Graph
         from agent_graph import app_graph
         try:
             inputs = {
-                "original_text": final_input_content, 
+                "sources": list(sources), 
                 "chunks": [], 
                 "partial_cards": [], 
                 "final_cards": [],
                 "deck_id": deck_id,
-                "flowcharts": []
+                "flowcharts": [],
+                "section_flowcharts": []
             }
-            result = app_graph.invoke(inputs)
+            result = await run_in_threadpool(app_graph.invoke, inputs) # Keep the event loop free for /chat and polling
             cards_data = result.get("final_cards", [])
             flowcharts = result.get("flowcharts", [])
             
             # Normalize
             cards = []
             for c in cards_data:
-                if isinstance(c, dict):
-                    cards.append({"q": c.get("q", ""), "a": c.get("a", "")})
-                else:
-                    cards.append({"q": c.q, "a": c.a})
+                if not isinstance(c, dict):
+                    c = c.model_dump() if hasattr(c, "model_dump") else {"q": c.q, "a": c.a}
+                cards.append({
+                    "q": c.get("q", ""),
+                    "a": c.get("a", ""),
+                    "topic": c.get("topic"),
+                    "source_file": c.get("source_file"),
+                    "page_start": c.get("page_start"),
+                    "page_end": c.get("page_end")
+                })
                     
         except Exception as e:
              print(f"Agent Graph Error: {e}")
@@ -139,9 +153,8 @@ async def generate_deck(files: List[UploadFile] = File(...)):
 
         print(f"Agents finished. Generated {len(cards)} cards.")
 
-        # 3. Create Anki Deck
-        deck_name = f"FlashDeck_{deck_id[:8]}" 
-        output_file = create_anki_deck(cards, deck_name=deck_name)
+        # 3. Cards/flowcharts were stored by the graph; the .apkg is built on demand by the export endpoint
+        await run_in_threadpool(deck_store.finish_deck, deck_id)
         
         # 4. Return Output
         return {
@@ -150,27 +163,135 @@ async def generate_deck(files: List[UploadFile] = File(...)):
             "deck_id": deck_id,
             "cards": cards,
             "flowcharts": flowcharts,
-            "download_path": output_file
+            "files": files_meta,
+            "download_path": app.url_path_for("export_deck", deck_id=deck_id) + "?format=apkg"
         }
         
+    except HTTPException as e:
+        await run_in_threadpool(deck_store.finish_deck, deck_id, "failed", str(e.detail))
+        raise
     except Exception as e:
         print(f"Unexpected Error in Generate: {e}")
+        await run_in_threadpool(deck_store.finish_deck, deck_id, "failed", str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/decks/{deck_id}")
+async def get_deck(deck_id: str):
+    """
+    Deck metadata, job status, topics and flowcharts from the store (no regeneration).
+    """
+    deck = await run_in_threadpool(deck_store.get_deck, deck_id)
+    if deck is None:
+        raise HTTPException(status_code=404, detail=f"Deck not found: {deck_id}")
+    deck["topics"] = await run_in_threadpool(deck_store.list_topics, deck_id)
+    return deck
+
+@app.get("/decks/{deck_id}/cards")
+async def get_deck_cards(deck_id: str, limit: int = 50, after: int = -1, topic: Optional[str] = None):
+    """
+    Pages through a deck's cards. Pass the returned 'next_after' as 'after' for the next page.
+    """
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 1000")
+    if not await run_in_threadpool(deck_store.deck_exists, deck_id):
+        raise HTTPException(status_code=404, detail=f"Deck not found: {deck_id}")
+    return await run_in_threadpool(deck_store.get_cards, deck_id, limit, after, topic)
+
+@app.get("/decks/{deck_id}/export")
+async def export_deck(deck_id: str, format: str = "apkg"):
+    """
+    Re-exports a stored deck without regenerating it.
+    apkg is written in a worker thread to a per-request file that is deleted once sent; csv/tsv/json are streamed.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format '{format}'. Use one of: {', '.join(EXPORT_FORMATS)}")
+    
+    deck = await run_in_threadpool(deck_store.get_deck, deck_id)
+    if deck is None:
+        raise HTTPException(status_code=404, detail=f"Deck not found: {deck_id}")
+    deck["cards"] = deck_store.iter_cards(deck_id) # Read lazily while streaming
+    
+    filename = f"{deck['deck_name']}.{format}"
+    if format == "apkg":
+        output_file = new_export_path(deck_id)
+        try:
+            await run_in_threadpool(
+                create_anki_deck, deck["cards"], deck_name=deck["deck_name"], deck_id=deck_id, output_path=output_file
+            )
+        except Exception:
+            os.remove(output_file)
+            raise
+        return FileResponse(
+            output_file, media_type=EXPORT_FORMATS[format], filename=filename,
+            background=BackgroundTask(os.remove, output_file)
+        )
+    
+    return StreamingResponse(
+        iter_export(deck, format),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+class SearchRequest(BaseModel):
+    query: str
+    deck_ids: List[str]
+    k_per_deck: int = 4
+    limit: int = 10
+    offset: int = 0
+    budget_ms: int = 2000 # Decks not answered within the budget are skipped
+    source_files: Optional[List[str]] = None # Restrict the search to these uploaded files
+
+@app.post("/search")
+async def search_across_decks(req: SearchRequest):
+    if not req.deck_ids:
+        raise HTTPException(status_code=400, detail="deck_ids must not be empty")
+    try:
+        return await run_in_threadpool(
+            search_decks, req.query, req.deck_ids,
+            k_per_deck=req.k_per_deck, limit=req.limit, offset=req.offset, budget_ms=req.budget_ms,
+            source_files=req.source_files
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 class ChatRequest(BaseModel):
     message: str
     deck_id: Optional[str] = None
+    deck_ids: Optional[List[str]] = None # Search several decks at once (takes precedence over deck_id)
+    source_files: Optional[List[str]] = None # Restrict retrieval to these uploaded files (with deck_id or deck_ids)
+
+def deck_exists_anywhere(deck_id: str) -> bool:
+    """
+    Decks indexed before the deck store existed have no row there, only vectors: those stay chattable.
+    """
+    return deck_store.deck_exists(deck_id) or deck_indexed(deck_id)
 
 @app.post("/chat")
 async def chat_with_deck(req: ChatRequest):
+    if req.deck_id and not req.deck_ids and not await run_in_threadpool(deck_exists_anywhere, req.deck_id):
+        raise HTTPException(status_code=404, detail=f"Deck not found: {req.deck_id}")
     try:
         print(f"🤖 User Query: {req.message}")
-        print(f"🔍 Retrieving context for Deck: {req.deck_id}...")
+        print(f"🔍 Retrieving context for Deck: {req.deck_ids or req.deck_id}...")
         
         # 1. Retrieve Context
-        docs = query_vector_db(req.message, req.deck_id)
-        print(f"📄 Retrieved {len(docs)} relevant chunks.")
-        context_text = "\n\n".join([d.page_content for d in docs])
+        if req.deck_ids:
+            found = await run_in_threadpool(search_decks, req.message, req.deck_ids, limit=4, source_files=req.source_files)
+            hits = found["results"]
+        else:
+            docs = query_vector_db(req.message, req.deck_id, source_files=req.source_files)
+            hits = [
+                {
+                    "content": d.page_content,
+                    "deck_id": d.metadata.get("deck_id"),
+                    "source": d.metadata.get("source", "unknown"),
+                    "page_start": d.metadata.get("page_start", d.metadata.get("page_number")),
+                    "page_end": d.metadata.get("page_end", d.metadata.get("page_number"))
+                }
+                for d in docs
+            ]
+        print(f"📄 Retrieved {len(hits)} relevant chunks.")
+        context_text = "\n\n".join([h["content"] for h in hits])
         
         if not context_text:
             context_text = "No relevant context found in the uploaded documents."
@@ -195,7 +316,16 @@ async def chat_with_deck(req: ChatRequest):
         answer = chain.invoke({"context": context_text, "question": req.message})
         print("✅ Answer Generated.")
         
-        return {"answer": answer, "sources": [d.metadata.get("source", "unknown") for d in docs]}
+        sources = [
+            {
+                "deck_id": h["deck_id"],
+                "file": h["source"],
+                "page_start": h["page_start"],
+                "page_end": h["page_end"]
+            }
+            for h in hits
+        ]
+        return {"answer": answer, "sources": sources}
         
     except Exception as e:
         print(f"Chat Error: {e}")
@@ -1,16 +1,22 @@
 import os
 import shutil
 import pickle
-from typing import List, Optional
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
 from uuid import uuid4
 
+import numpy as np
+
 # LangChain Imports
 from langchain_chroma import Chroma
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_classic.retrievers import ParentDocumentRetriever
 # from langchain.retrievers import ParentDocumentRetriever # Fallback failed
-from langchain_classic.storage import LocalFileStore
+from langchain_classic.storage import LocalFileStore, EncoderBackedStore
 # from langchain.storage import LocalFileStore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 # from langchain_community.storage import LocalFileStore # Explicit import if needed
@@ -19,6 +25,7 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CHROMA_DIR = os.path.join(BASE_DIR, "chroma_db")
 DOC_STORE_DIR = os.path.join(BASE_DIR, "doc_store") # For Parent Docs
+FULL_VECTOR_DIR = os.path.join(BASE_DIR, "vector_store") # Full-precision child vectors for re-rank
 
 # Ensure directories exist
 os.makedirs(DOC_STORE_DIR, exist_ok=True)
@@ -29,9 +36,66 @@ load_dotenv()
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
-def get_embeddings():
+# --- COMPACT VECTOR CONFIG ---
+# text-embedding-3-small is Matryoshka-trained: the first N dims (re-normalized) are a usable embedding.
+FULL_EMBEDDING_DIMS = 1536
+EMBEDDING_DIMS = int(os.getenv("RAG_EMBEDDING_DIMS", FULL_EMBEDDING_DIMS))
+# Re-rank the top candidates of the compact index against stored float16 full vectors.
+RERANK_ENABLED = os.getenv("RAG_VECTOR_RERANK", "false").lower() == "true"
+RERANK_CANDIDATE_FACTOR = int(os.getenv("RAG_RERANK_CANDIDATE_FACTOR", 4))
+
+# --- MULTI-DECK SEARCH CONFIG ---
+# One bounded pool per process keeps fan-out (and tail latency) predictable under load.
+SEARCH_WORKERS = int(os.getenv("RAG_SEARCH_WORKERS", 16))
+MAX_SEARCH_DECKS = int(os.getenv("RAG_MAX_SEARCH_DECKS", 500))
+# Decks per filtered query. Embedded Chroma serializes concurrent queries,
+# so one $in query per group beats one query per deck.
+SEARCH_GROUP_SIZE = int(os.getenv("RAG_SEARCH_GROUP_SIZE", 25))
+# First guess of child hits needed per distinct parent (~2000-char parents, 400-char children); doubled while short.
+SEARCH_CHILDREN_PER_PARENT = 4
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="deck-search")
+
+def truncate_embedding(vector: List[float], dims: int) -> List[float]:
+    """
+    Matryoshka truncation: keep the first `dims` components and re-normalize to unit length.
+    """
+    v = np.asarray(vector, dtype=np.float32)[:dims]
+    norm = np.linalg.norm(v)
+    if norm > 0:
+        v = v / norm
+    return v.tolist()
+
+def vector_key(text: str) -> str:
+    """
+    Content-addressed key for a child chunk's full-precision vector.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class CompactEmbeddings(Embeddings):
+    """
+    Wraps the full embedding model and hands Chroma truncated vectors.
+    When a full-vector store is given, the float16 full vectors are kept there for re-ranking.
     """
-    Returns the embedding function. 
+    def __init__(self, base: Embeddings, dims: int, full_vector_store=None):
+        self.base = base
+        self.dims = dims
+        self.full_vector_store = full_vector_store
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        full = self.base.embed_documents(texts)
+        if self.full_vector_store is not None:
+            self.full_vector_store.mset([
+                (vector_key(t), np.asarray(v, dtype=np.float16).tobytes())
+                for t, v in zip(texts, full)
+            ])
+        return [truncate_embedding(v, self.dims) for v in full]
+
+    def embed_query(self, text: str) -> List[float]:
+        return truncate_embedding(self.base.embed_query(text), self.dims)
+
+def get_full_embeddings():
+    """
+    Returns the full-precision embedding function. 
     Using OpenRouter compatible endpoint (text-embedding-3-small).
     """
     return OpenAIEmbeddings(
@@ -41,12 +105,44 @@ def get_embeddings():
         check_embedding_ctx_length=False 
     )
 
+def get_full_vector_store():
+    """
+    Returns the LocalFileStore holding float16 full-precision child vectors (re-rank only).
+    """
+    os.makedirs(FULL_VECTOR_DIR, exist_ok=True)
+    return LocalFileStore(FULL_VECTOR_DIR)
+
+def get_embeddings():
+    """
+    Returns the embedding function used by the child index.
+    Full 1536-dim vectors by default; truncated when RAG_EMBEDDING_DIMS is set lower.
+    """
+    base = get_full_embeddings()
+    if EMBEDDING_DIMS >= FULL_EMBEDDING_DIMS:
+        return base
+    return CompactEmbeddings(
+        base,
+        EMBEDDING_DIMS,
+        full_vector_store=get_full_vector_store() if RERANK_ENABLED else None
+    )
+
+COLLECTION_PREFIX = "flashdeck_knowledge_child"
+
+def get_collection_name() -> str:
+    """
+    Vectors of different sizes can't share a collection, so compact indexes get their own.
+    Changing RAG_EMBEDDING_DIMS switches collection: run reindex_vectors.py to carry existing decks over.
+    """
+    if EMBEDDING_DIMS >= FULL_EMBEDDING_DIMS:
+        return COLLECTION_PREFIX # New collection for v4 logic
+    return f"{COLLECTION_PREFIX}_d{EMBEDDING_DIMS}"
+
 def get_vectorstore():
     """
     Returns the persistent Chroma VectorStore (Child Docs).
     """
     return Chroma(
-        collection_name="flashdeck_knowledge_child", # New collection for v4 logic
+        collection_name=get_collection_name(),
         embedding_function=get_embeddings(),
         persist_directory=CHROMA_DIR
     )
@@ -54,12 +150,77 @@ def get_vectorstore():
 def get_docstore():
     """
     Returns the LocalFileStore for Parent Docs (blob storage).
+    Documents are pickled on the way in/out, since LocalFileStore only holds bytes.
+    """
+    return EncoderBackedStore(
+        LocalFileStore(DOC_STORE_DIR),
+        key_encoder=lambda key: key,
+        value_serializer=pickle.dumps,
+        value_deserializer=pickle.loads
+    )
+
+def rerank_scores(full_query, candidates: List[Document], full_vector_store) -> List[Optional[float]]:
+    """
+    Exact cosine of each candidate against its stored full vector (None if it has none).
+    """
+    full_query = np.asarray(full_query, dtype=np.float32)
+    query_norm = np.linalg.norm(full_query) or 1.0
+    stored = full_vector_store.mget([vector_key(c.page_content) for c in candidates])
+    
+    scores = []
+    for raw in stored:
+        if raw is None:
+            scores.append(None)
+        else:
+            v = np.frombuffer(raw, dtype=np.float16).astype(np.float32)
+            scores.append(float(v @ full_query / ((np.linalg.norm(v) * query_norm) or 1.0)))
+    return scores
+
+def rerank_candidates(full_query, candidates: List[Document], full_vector_store) -> List[Document]:
     """
-    return LocalFileStore(DOC_STORE_DIR)
+    Re-orders compact-index candidates by exact cosine against their stored full vectors.
+    """
+    scored = []
+    for rank, (child, score) in enumerate(zip(candidates, rerank_scores(full_query, candidates, full_vector_store))):
+        if score is None:
+            # Indexed before re-rank was enabled: keep it, behind every re-scored candidate.
+            score = -1.0 - rank
+        scored.append((score, child))
+    scored.sort(key=lambda pair: pair[0], reverse=True)
+    return [child for _, child in scored]
+
+class RerankingParentDocumentRetriever(ParentDocumentRetriever):
+    """
+    ParentDocumentRetriever over a compact index.
+    Over-fetches children, re-scores them with exact cosine on the stored full vectors,
+    then returns the parents of the best k.
+    """
+    full_embeddings: Embeddings
+    full_vector_store: LocalFileStore
+    candidate_factor: int = RERANK_CANDIDATE_FACTOR
+
+    def _get_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        k = self.search_kwargs.get("k", 4)
+        full_query = np.asarray(self.full_embeddings.embed_query(query), dtype=np.float32)
+        candidates = self.vectorstore.similarity_search_by_vector(
+            truncate_embedding(full_query, EMBEDDING_DIMS),
+            k=k * self.candidate_factor,
+            filter=self.search_kwargs.get("filter")
+        )
+        
+        reranked = rerank_candidates(full_query, candidates, self.full_vector_store)
+        
+        # We do this to maintain the order of the IDs after re-ranking
+        ids = []
+        for d in reranked[:k]:
+            if self.id_key in d.metadata and d.metadata[self.id_key] not in ids:
+                ids.append(d.metadata[self.id_key])
+        docs = self.docstore.mget(ids)
+        return [d for d in docs if d is not None]
 
 def get_retriever():
     """
-    Constructs the ParentDocumentRetriever.
+    Constructs the ParentDocumentRetriever (re-ranking variant for compact indexes with RAG_VECTOR_RERANK).
     """
     vectorstore = get_vectorstore()
     store = get_docstore()
@@ -72,6 +233,16 @@ def get_retriever():
     # But let's set a safe large limit (e.g. 2000 chars) in case we get raw text.
     parent_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
 
+    if RERANK_ENABLED and EMBEDDING_DIMS < FULL_EMBEDDING_DIMS:
+        return RerankingParentDocumentRetriever(
+            vectorstore=vectorstore,
+            docstore=store,
+            child_splitter=child_splitter,
+            parent_splitter=parent_splitter,
+            full_embeddings=get_full_embeddings(),
+            full_vector_store=get_full_vector_store(),
+        )
+
     retriever = ParentDocumentRetriever(
         vectorstore=vectorstore,
         docstore=store,
@@ -80,27 +251,98 @@ def get_retriever():
     )
     return retriever
 
-def index_content(text_chunks: List[str], deck_id: str, source_file: str):
+def reindex_collection(batch_size: int = 100) -> int:
+    """
+    Rebuilds the active child collection from the parent docs in the doc store.
+    Used after changing RAG_EMBEDDING_DIMS: parents keep their ids, so existing decks become searchable again.
+    Parents that already have children in the collection are skipped. Returns the number of parents indexed.
+    """
+    vectorstore = get_vectorstore()
+    store = get_docstore()
+    indexed = {m.get("doc_id") for m in vectorstore.get(include=["metadatas"])["metadatas"]}
+    
+    # No parent splitter: stored parents are re-used as-is, under their existing ids
+    retriever = ParentDocumentRetriever(
+        vectorstore=vectorstore,
+        docstore=store,
+        child_splitter=RecursiveCharacterTextSplitter(chunk_size=400, chunk_overlap=50),
+    )
+    
+    keys = [key for key in store.yield_keys() if key not in indexed]
+    total = 0
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i + batch_size]
+        pairs = [(key, doc) for key, doc in zip(batch, store.mget(batch)) if doc is not None]
+        if not pairs:
+            continue
+        retriever.add_documents([doc for _, doc in pairs], ids=[key for key, _ in pairs], add_to_docstore=False)
+        total += len(pairs)
+        print(f"--- RAG: Re-indexed {total}/{len(keys)} parents into {get_collection_name()} ---")
+    return total
+
+def check_index_migration() -> List[str]:
+    """
+    Startup check for indexes left behind by a RAG_EMBEDDING_DIMS / RAG_VECTOR_RERANK change.
+    Returns the warnings (also printed).
+    """
+    warnings = []
+    if not os.path.exists(os.path.join(CHROMA_DIR, "chroma.sqlite3")):
+        return warnings # Fresh install: nothing indexed yet (and don't create the DB just to look)
+    try:
+        import chromadb
+        client = chromadb.PersistentClient(path=CHROMA_DIR)
+        counts = {
+            c.name: c.count() for c in client.list_collections()
+            if c.name.startswith(COLLECTION_PREFIX)
+        }
+    except Exception as e:
+        print(f"RAG Migration Check Failed: {e}")
+        return warnings
+    
+    active = get_collection_name()
+    others = {name: n for name, n in counts.items() if name != active and n}
+    if not counts.get(active) and others:
+        warnings.append(
+            f"Collection '{active}' is empty but {', '.join(f'{name} ({n} chunks)' for name, n in others.items())} "
+            f"is not: decks indexed under another RAG_EMBEDDING_DIMS are not searchable. "
+            f"Run 'python reindex_vectors.py' to re-index them."
+        )
+    
+    rerank_active = RERANK_ENABLED and EMBEDDING_DIMS < FULL_EMBEDDING_DIMS
+    if not rerank_active and os.path.isdir(FULL_VECTOR_DIR) and os.listdir(FULL_VECTOR_DIR):
+        warnings.append(f"'{FULL_VECTOR_DIR}' is unused without compact re-rank and can be deleted.")
+    
+    for warning in warnings:
+        print(f"⚠️ {warning}")
+    return warnings
+
+def index_content(text_chunks: List[str], deck_id: str, source_file: str,
+                  page_ranges: Optional[List[Tuple[int, int]]] = None):
     """
     Indexes content using the Advanced RAG (Parent-Child) strategy.
     
     Args:
         text_chunks: List of strings. In v3/v4 logic, these are usually full Pages (transcribed or extracted).
+        source_file: Name of the uploaded file the chunks came from (stored as 'source').
+        page_ranges: Optional (page_start, page_end) per chunk. Defaults to one page per chunk.
     """
     if not text_chunks:
         return
         
-    print(f"--- RAG (Advanced): Indexing {len(text_chunks)} Parent Chunks for Deck {deck_id} ---")
+    print(f"--- RAG (Advanced): Indexing {len(text_chunks)} Parent Chunks for Deck {deck_id} ({source_file}) ---")
     
     # Convert strings to Documents
     documents = []
     for i, chunk in enumerate(text_chunks):
+        page_start, page_end = page_ranges[i] if page_ranges else (i + 1, i + 1)
         doc = Document(
             page_content=chunk,
             metadata={
                 "deck_id": deck_id, 
                 "source": source_file,
-                "page_number": i + 1
+                "page_number": page_start,
+                "page_start": page_start,
+                "page_end": page_end
             }
         )
         documents.append(doc)
@@ -115,28 +357,191 @@ def index_content(text_chunks: List[str], deck_id: str, source_file: str):
     
     print("--- RAG: Indexing Complete ---")
 
-def query_vector_db(query: str, deck_id: Optional[str] = None, k: int = 4):
+def build_filter(deck_id: Optional[str] = None, source_files: Optional[List[str]] = None,
+                 deck_ids: Optional[List[str]] = None):
+    """
+    Builds the Chroma metadata filter for a deck (or several) and/or a subset of their files.
+    Chroma needs an explicit $and when more than one field is constrained.
+    """
+    clauses = []
+    if deck_id:
+        clauses.append({"deck_id": deck_id})
+    if deck_ids:
+        clauses.append({"deck_id": deck_ids[0]} if len(deck_ids) == 1 else {"deck_id": {"$in": list(deck_ids)}})
+    if source_files:
+        clauses.append({"source": {"$in": list(source_files)}})
+
+    if not clauses:
+        return None
+    if len(clauses) == 1:
+        return clauses[0]
+    return {"$and": clauses}
+
+def deck_indexed(deck_id: str) -> bool:
+    """
+    True if the active collection holds any chunk of the deck (covers decks created before the deck store).
+    """
+    found = get_vectorstore().get(where={"deck_id": deck_id}, limit=1, include=[])
+    return bool(found["ids"])
+
+def query_vector_db(query: str, deck_id: Optional[str] = None, k: int = 4,
+                    source_files: Optional[List[str]] = None):
     """
     Queries the knowledge base using the Parent Document Retriever.
+    Optionally restricts retrieval to the given source files of the deck.
     """
     retriever = get_retriever()
     
     # Note: ParentDocumentRetriever search_kwargs are for the underlying vectorstore search
-    # We want to filter by deck_id.
-    if deck_id:
+    # We want to filter by deck_id (and optionally by file).
+    search_filter = build_filter(deck_id, source_files)
+    if search_filter:
         retriever.search_kwargs = {
-            "filter": {"deck_id": deck_id},
+            "filter": search_filter,
             "k": k
         }
     else:
         retriever.search_kwargs = {"k": k}
 
-    print(f"🔍 RAG Query: '{query}' (Deck: {deck_id})")
+    print(f"🔍 RAG Query: '{query}' (Deck: {deck_id}, Files: {source_files or 'all'})")
     results = retriever.invoke(query)
     
     # Results are the PARENT documents (large context).
     return results
 
+def search_decks(query: str, deck_ids: List[str], k_per_deck: int = 4, limit: int = 10,
+                 offset: int = 0, budget_ms: int = 2000, source_files: Optional[List[str]] = None) -> Dict:
+    """
+    Searches several decks at once.
+    The query is embedded once and groups of decks are searched concurrently.
+    Each deck contributes at most k_per_deck distinct parent docs (its own top-k).
+    The contributions are merged globally and paged with limit/offset.
+    A result set therefore holds at most len(deck_ids) * k_per_deck parents.
+    With source_files, only chunks of those uploaded files are searched, in every deck.
+    Decks whose group misses the latency budget are skipped and reported in 'timed_out_decks'.
+    """
+    deck_ids = list(dict.fromkeys(deck_ids)) # Drop duplicates, keep order
+    if len(deck_ids) > MAX_SEARCH_DECKS:
+        raise ValueError(f"Too many decks in one search ({len(deck_ids)} > {MAX_SEARCH_DECKS})")
+    if k_per_deck < 1 or limit < 1 or offset < 0:
+        raise ValueError("k_per_deck and limit must be positive and offset must not be negative")
+    
+    start = time.perf_counter()
+    vectorstore = get_vectorstore()
+    rerank = RERANK_ENABLED and EMBEDDING_DIMS < FULL_EMBEDDING_DIMS
+    full_vector_store = get_full_vector_store() if rerank else None
+    
+    # 1. Embed once for every deck
+    if EMBEDDING_DIMS < FULL_EMBEDDING_DIMS:
+        full_query = get_full_embeddings().embed_query(query)
+        query_vector = truncate_embedding(full_query, EMBEDDING_DIMS)
+    else:
+        full_query = query_vector = get_full_embeddings().embed_query(query)
+    
+    # 2. Fan out. A deck never needs more parents than its cap, nor more than
+    #    offset + limit + 1 (enough to fill this page and tell whether another follows).
+    need = min(k_per_deck, offset + limit + 1)
+    groups = [deck_ids[i:i + SEARCH_GROUP_SIZE] for i in range(0, len(deck_ids), SEARCH_GROUP_SIZE)]
+    
+    deadline = start + budget_ms / 1000
+    
+    def search_group(group: List[str]):
+        """
+        Top `need` distinct parents of every deck in the group, as (sort key, distance, parent id, child).
+        Several children can share a parent, so decks still short of `need` are re-queried
+        with twice the fetch size until they have enough, run out of children, or the deadline passes
+        (then they keep what they have). A group that starts after the deadline does no work:
+        its result would be discarded, and its worker is needed by the next search.
+        """
+        found_parents = {}
+        pending = list(group)
+        fetch_per_deck = need * SEARCH_CHILDREN_PER_PARENT * (RERANK_CANDIDATE_FACTOR if rerank else 1)
+        while pending and time.perf_counter() < deadline:
+            k = fetch_per_deck * len(pending)
+            search_filter = build_filter(deck_ids=pending, source_files=source_files)
+            found = vectorstore.similarity_search_by_vector_with_relevance_scores(
+                query_vector, k=k, filter=search_filter
+            )
+            # Chroma returns distances (lower is closer); re-rank sorts by exact cosine instead
+            if rerank:
+                cosines = rerank_scores(full_query, [child for child, _ in found], full_vector_store)
+                ranked = [
+                    ((0, -cos) if cos is not None else (1, distance), distance, child)
+                    for (child, distance), cos in zip(found, cosines)
+                ]
+            else:
+                ranked = [((0, distance), distance, child) for child, distance in found]
+            ranked.sort(key=lambda item: item[0])
+            
+            per_deck = {d: {} for d in pending}
+            for key, distance, child in ranked:
+                parents = per_deck.get(child.metadata.get("deck_id"))
+                parent_id = child.metadata.get("doc_id")
+                if parents is None or not parent_id or parent_id in parents or len(parents) >= need:
+                    continue
+                parents[parent_id] = (key, distance, parent_id, child)
+            
+            exhausted = len(found) < k # Every child of the pending decks has been seen
+            out_of_time = time.perf_counter() >= deadline
+            short = []
+            for d in pending:
+                if exhausted or out_of_time or len(per_deck[d]) >= need:
+                    found_parents[d] = list(per_deck[d].values())
+                else:
+                    short.append(d)
+            pending = short
+            fetch_per_deck *= 2
+        return [hit for hits in found_parents.values() for hit in hits]
+    
+    futures = {search_executor.submit(search_group, g): g for g in groups}
+    remaining = max(deadline - time.perf_counter(), 0)
+    done, pending = wait(futures, timeout=remaining)
+    for f in pending:
+        f.cancel() # Queued searches never start; running ones stop re-querying at the deadline
+    
+    hits = []
+    failed = []
+    for f in done:
+        try:
+            hits.extend(f.result())
+        except Exception as e:
+            print(f"Deck search failed ({futures[f]}): {e}")
+            failed.extend(futures[f])
+    
+    # 3. Global merge of every deck's top parents (best child first), then page
+    hits.sort(key=lambda hit: hit[0])
+    page = hits[offset:offset + limit]
+    
+    # 4. Load only this page's parents
+    parents = get_docstore().mget([parent_id for _, _, parent_id, _ in page])
+    results = []
+    for (_, distance, _, _), parent in zip(page, parents):
+        if parent is None:
+            continue
+        results.append({
+            "content": parent.page_content,
+            "deck_id": parent.metadata.get("deck_id"),
+            "source": parent.metadata.get("source", "unknown"),
+            "page_start": parent.metadata.get("page_start", parent.metadata.get("page_number")),
+            "page_end": parent.metadata.get("page_end", parent.metadata.get("page_number")),
+            "distance": distance
+        })
+    
+    next_offset = offset + limit if len(hits) > offset + limit else None
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    timed_out = [d for f in pending for d in futures[f]]
+    searched = len(deck_ids) - len(timed_out) - len(failed)
+    print(f"🔍 Multi-deck RAG Query: '{query}' ({searched}/{len(deck_ids)} decks, {elapsed_ms:.0f} ms)")
+    
+    return {
+        "results": results,
+        "next_offset": next_offset,
+        "searched_decks": searched,
+        "timed_out_decks": timed_out,
+        "failed_decks": failed,
+        "elapsed_ms": elapsed_ms
+    }
+
 def check_health():
     """
     Checks if ChromaDB is responding.
@@ -160,6 +565,7 @@ def clear_deck_data(deck_id: str):
 # --- STARTUP MESSAGE ---
 print("---------------------------------------------------------------")
 print(f"✅ Advanced RAG Engine (Parent Doc Retriever) Configured")
-print(f"📂 Vector Store: {CHROMA_DIR}")
+print(f"📂 Vector Store: {CHROMA_DIR} ({get_collection_name()}, {min(EMBEDDING_DIMS, FULL_EMBEDDING_DIMS)} dims, re-rank {'on' if RERANK_ENABLED else 'off'})")
 print(f"📂 Parent Store: {DOC_STORE_DIR}")
+check_index_migration()
 print("---------------------------------------------------------------")
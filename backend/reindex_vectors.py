@@ -0,0 +1,24 @@
+"""
+Re-indexes every stored parent doc into the active child collection.
+
+Run after changing RAG_EMBEDDING_DIMS: each dimension has its own Chroma collection, so decks indexed
+under the old setting are not searchable until they are re-embedded. Parents already in the active
+collection are skipped, so the script can be re-run after an interruption.
+
+Usage:
+    RAG_EMBEDDING_DIMS=512 python reindex_vectors.py
+"""
+import argparse
+
+import rag_engine
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=100, help="Parents embedded per round trip")
+    args = parser.parse_args()
+
+    total = rag_engine.reindex_collection(batch_size=args.batch_size)
+    print(f"Re-indexed {total} parents into {rag_engine.get_collection_name()}.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import os
+import sys
+import hashlib
+from typing import List
+
+import numpy as np
+import pytest
+
+# Backend modules are imported top-level (as main.py does), and never need a real API key here.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+
+from langchain_core.embeddings import Embeddings
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic stand-in for OpenAIEmbeddings: a unit vector seeded by the text.
+    """
+    def __init__(self, dims: int = 1536):
+        self.dims = dims
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+        v = np.random.default_rng(seed).standard_normal(self.dims)
+        return (v / np.linalg.norm(v)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text)
+
+@pytest.fixture(scope="session")
+def hash_embeddings():
+    return HashEmbeddings
@@ -0,0 +1,62 @@
+"""
+Tests for the graph's planning helpers: flowchart sections and the cards each section's chart sees.
+"""
+import pytest
+
+import agent_graph
+from agent_graph import plan_sections, sample_section_cards
+
+def batches_for(files):
+    """
+    files: (file name, batch count) per upload, in upload order.
+    """
+    batches = []
+    for source_index, (name, count) in enumerate(files):
+        for j in range(count):
+            batches.append({"source_index": source_index, "source_file": name,
+                            "page_start": j * 2 + 1, "page_end": j * 2 + 3})
+    for i, b in enumerate(batches):
+        b["batch_id"] = i
+    return batches
+
+def test_uploads_with_the_same_name_get_separate_sections():
+    sections = plan_sections(batches_for([("notes.pdf", 3), ("notes.pdf", 2)]))
+    assert [s["batch_ids"] for s in sections] == [[0, 1, 2], [3, 4]]
+    assert [s["ranges"] for s in sections] == [
+        [{"source_file": "notes.pdf", "page_start": 1, "page_end": 7}],
+        [{"source_file": "notes.pdf", "page_start": 1, "page_end": 5}],
+    ]
+
+def test_merged_sections_keep_one_page_range_per_file(monkeypatch):
+    monkeypatch.setattr(agent_graph, "MAX_FLOWCHARTS", 2)
+    sections = plan_sections(batches_for([("a.pdf", 1), ("b.pdf", 2), ("c.pdf", 1)]))
+    assert len(sections) == 2
+    assert sections[0]["ranges"] == [
+        {"source_file": "a.pdf", "page_start": 1, "page_end": 3},
+        {"source_file": "b.pdf", "page_start": 1, "page_end": 5},
+    ]
+
+def cards(batch_id, n):
+    return [{"q": f"b{batch_id} q{j}"} for j in range(n)]
+
+def test_sample_covers_every_batch_of_a_large_section():
+    cards_by_batch = {b: cards(b, 18) for b in range(16)}
+    sample = sample_section_cards(cards_by_batch, list(range(16)), 40)
+    assert len(sample) == 40
+    per_batch = [sum(c["q"].startswith(f"b{b} ") for c in sample) for b in range(16)]
+    assert min(per_batch) >= 2 and max(per_batch) <= 3
+    assert sample == sorted(sample, key=lambda c: int(c["q"].split()[0][1:])) # Document order
+
+def test_quota_left_by_short_batches_goes_to_the_rest():
+    cards_by_batch = {0: cards(0, 1), 1: cards(1, 50), 2: []}
+    sample = sample_section_cards(cards_by_batch, [0, 1, 2], 40)
+    assert len(sample) == 40 and sample[0] == {"q": "b0 q0"}
+
+def test_more_batches_than_cards_spreads_over_the_section():
+    cards_by_batch = {b: cards(b, 3) for b in range(100)}
+    sample = sample_section_cards(cards_by_batch, list(range(100)), 10)
+    assert [c["q"] for c in sample] == [f"b{b} q0" for b in range(0, 100, 10)]
+
+@pytest.mark.parametrize("max_cards", [0, -1])
+def test_no_cards_when_the_cap_is_not_positive(max_cards):
+    assert sample_section_cards({0: cards(0, 3)}, [0], max_cards) == []
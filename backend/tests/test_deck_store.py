@@ -0,0 +1,107 @@
+"""
+Tests for the SQLite deck store (keyset paging, topic filter, create/409) on a throwaway DB_PATH.
+"""
+import uuid
+
+import pytest
+
+import deck_store
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(deck_store, "DB_PATH", str(tmp_path / "flashdeck.db"))
+
+def make_deck(deck_id: str, n: int, topics=("Intro", "Mechanism", "Summary")):
+    deck_store.create_deck(deck_id, f"FlashDeck_{deck_id[:8]}")
+    deck_store.save_cards(deck_id, [
+        {"q": f"q{i}", "a": f"a{i}", "topic": topics[i % len(topics)], "source_file": "a.pdf",
+         "page_start": i + 1, "page_end": i + 1}
+        for i in range(n)
+    ])
+
+def pages(deck_id: str, limit: int, topic=None):
+    out = []
+    after = -1
+    while True:
+        page = deck_store.get_cards(deck_id, limit=limit, after=after, topic=topic)
+        out.append(page)
+        if page["next_after"] is None:
+            return out
+        after = page["next_after"]
+
+# --- Keyset paging ---
+
+def test_exact_page_boundary_has_no_empty_trailing_page():
+    make_deck("d", 10)
+    result = pages("d", 5)
+    assert [len(p["cards"]) for p in result] == [5, 5]
+    assert result[0]["next_after"] == 4
+    assert result[1]["next_after"] is None
+
+def test_partial_last_page():
+    make_deck("d", 11)
+    result = pages("d", 5)
+    assert [len(p["cards"]) for p in result] == [5, 5, 1]
+    assert [c["q"] for p in result for c in p["cards"]] == [f"q{i}" for i in range(11)]
+
+def test_one_card_pages_and_a_single_full_page():
+    make_deck("d", 3)
+    assert [len(p["cards"]) for p in pages("d", 1)] == [1, 1, 1]
+    only = deck_store.get_cards("d", limit=3)
+    assert len(only["cards"]) == 3 and only["next_after"] is None
+
+def test_empty_and_unknown_decks():
+    make_deck("d", 0)
+    assert deck_store.get_cards("d") == {"cards": [], "next_after": None}
+    assert deck_store.get_cards("missing") == {"cards": [], "next_after": None}
+
+def test_topic_filter_pages_in_deck_order():
+    make_deck("d", 20)
+    result = pages("d", 3, topic="Mechanism")
+    cards = [c for p in result for c in p["cards"]]
+    assert [c["position"] for c in cards] == list(range(1, 20, 3))
+    assert all(c["topic"] == "Mechanism" for c in cards)
+    assert [len(p["cards"]) for p in result] == [3, 3, 1]
+
+def test_paging_is_per_deck():
+    make_deck("a", 4)
+    make_deck("b", 6)
+    assert sum(len(p["cards"]) for p in pages("a", 3)) == 4
+    assert sum(len(p["cards"]) for p in pages("b", 3)) == 6
+
+def test_iter_cards_streams_every_card_across_chunks(monkeypatch):
+    monkeypatch.setattr(deck_store, "ITER_CHUNK", 4)
+    make_deck("d", 12) # Exact multiple of the chunk size
+    cards = list(deck_store.iter_cards("d"))
+    assert [c["q"] for c in cards] == [f"q{i}" for i in range(12)]
+    assert "position" not in cards[0]
+
+def test_list_topics_in_first_appearance_order():
+    make_deck("d", 7)
+    assert deck_store.list_topics("d") == [
+        {"topic": "Intro", "cards": 3}, {"topic": "Mechanism", "cards": 2}, {"topic": "Summary", "cards": 2}
+    ]
+
+# --- create_deck / 409 ---
+
+def test_create_deck_never_overwrites():
+    make_deck("d", 5)
+    deck_store.finish_deck("d")
+    with pytest.raises(deck_store.DeckExistsError):
+        deck_store.create_deck("d", "Other")
+    deck = deck_store.get_deck("d")
+    assert (deck["deck_name"], deck["status"], deck["card_count"]) == ("FlashDeck_d", "ready", 5)
+
+def test_generate_with_an_existing_deck_id_is_409():
+    from fastapi.testclient import TestClient
+    import main
+
+    deck_id = str(uuid.uuid4())
+    make_deck(deck_id, 2)
+    deck_store.finish_deck(deck_id)
+    res = TestClient(main.app).post(
+        "/generate", data={"deck_id": deck_id}, files=[("files", ("a.pdf", b"%PDF-1.4", "application/pdf"))]
+    )
+    assert res.status_code == 409
+    deck = deck_store.get_deck(deck_id)
+    assert deck["status"] == "ready" and deck["card_count"] == 2
@@ -0,0 +1,134 @@
+"""
+Tests for GenerationClient's streamed card parsing and its salvage/retry policy.
+A scripted chat model stands in for the LLM, so no API key or network is needed.
+"""
+import json
+from typing import Any, List, Tuple
+
+import pytest
+from langchain_core.language_models import SimpleChatModel
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+from pydantic import BaseModel
+
+from generation_engine import CardStreamParser, GenerationClient
+
+class Flashcard(BaseModel):
+    q: str
+    a: str
+    topic: str
+
+class CardList(BaseModel):
+    cards: List[Flashcard]
+
+CARDS = [
+    {"q": 'What is "quoted" {braced} [bracketed]?', "a": 'Escapes: \\ and \" and } survive', "topic": "Syntax"},
+    {"q": "Q2", "a": "A2", "topic": "Intro"},
+    {"q": "Q3", "a": "A3", "topic": "Summary"},
+]
+FULL = json.dumps({"cards": CARDS})
+FENCED = "Here are the flashcards:\n```json\n" + json.dumps({"cards": CARDS}, indent=2) + "\n```"
+BARE_LIST = json.dumps(CARDS)
+
+def feed_in_chunks(text: str, size: int) -> CardStreamParser:
+    parser = CardStreamParser()
+    for i in range(0, len(text), size):
+        parser.feed(text[i:i + size])
+    return parser
+
+def end_of_card(text: str, n: int) -> int:
+    """
+    Offset just past the closing brace of the n-th card (1-based).
+    """
+    parser = CardStreamParser()
+    for i, ch in enumerate(text):
+        parser.feed(ch)
+        if len(parser.cards) == n:
+            return i + 1
+    raise AssertionError(f"card {n} never closed")
+
+# --- CardStreamParser ---
+
+@pytest.mark.parametrize("text", [FULL, FENCED, BARE_LIST], ids=["object", "fenced", "bare-list"])
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 100000])
+def test_parser_decodes_every_card_at_any_chunk_boundary(text, size):
+    # Size 1 and 2 put boundaries inside strings, right after backslashes and inside escape pairs
+    assert feed_in_chunks(text, size).cards == CARDS
+
+def test_parser_returns_cards_as_their_objects_close():
+    parser = CardStreamParser()
+    boundary = end_of_card(FULL, 1)
+    assert parser.feed(FULL[:boundary - 1]) == []
+    assert parser.feed(FULL[boundary - 1:boundary]) == [CARDS[0]]
+
+@pytest.mark.parametrize("text", [FULL, FENCED, BARE_LIST], ids=["object", "fenced", "bare-list"])
+def test_cut_off_stream_keeps_only_closed_cards(text):
+    for cut in range(len(text)):
+        cards = feed_in_chunks(text[:cut], 5).cards
+        assert cards == CARDS[:len(cards)]
+
+def test_cut_right_after_a_closing_brace_keeps_that_card():
+    cut = end_of_card(FULL, 3)
+    assert feed_in_chunks(FULL[:cut], 4).cards == CARDS
+
+def test_braces_inside_strings_do_not_close_a_card():
+    text = json.dumps({"cards": [{"q": "}}}", "a": "{{{", "topic": "]"}]})
+    parser = CardStreamParser()
+    parser.feed(text[:text.index("{{{")])
+    assert parser.cards == []
+    parser.feed(text[text.index("{{{"):])
+    assert parser.cards == [{"q": "}}}", "a": "{{{", "topic": "]"}]
+
+# --- GenerationClient.generate ---
+
+class ScriptedModel(SimpleChatModel):
+    """
+    Streams one scripted (text, cut) response per call; cut=True raises after the text, like a dropped stream.
+    """
+    script: List[Tuple[str, bool]]
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _call(self, *args: Any, **kwargs: Any) -> str:
+        raise NotImplementedError
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        text, cut = self.script[min(self.calls, len(self.script) - 1)]
+        self.calls += 1
+        for i in range(0, len(text), 5):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text[i:i + 5]))
+        if cut:
+            raise ConnectionError("stream dropped")
+
+def generate(script, max_attempts: int = 3):
+    model = ScriptedModel(script=script)
+    result = GenerationClient(model, CardList, Flashcard, max_attempts=max_attempts).generate(["text"], "text")
+    return result["cards"], model.calls
+
+def test_complete_response_is_returned_without_retry():
+    assert generate([(FULL, False)]) == (CARDS, 1)
+
+def test_complete_response_with_no_cards_is_not_retried():
+    assert generate([('{"cards": []}', False)]) == ([], 1)
+
+def test_cut_off_stream_is_retried_and_the_full_retry_wins():
+    assert generate([(FULL[:end_of_card(FULL, 1)], True), (FULL, False)]) == (CARDS, 2)
+
+def test_salvaged_cards_win_when_the_retry_does_worse():
+    first = FULL[:end_of_card(FULL, 2) + 3]
+    second = FULL[:end_of_card(FULL, 1)]
+    assert generate([(first, True), (second, True)]) == (CARDS[:2], 2)
+
+def test_stream_dropped_without_error_counts_as_truncated():
+    # No exception (e.g. the connection closed before [DONE]), but the JSON never finished
+    assert generate([(FULL[:end_of_card(FULL, 2)], False), (FULL, False)]) == (CARDS, 2)
+
+def test_invalid_cards_are_dropped_from_a_salvage():
+    bad = json.dumps({"cards": [CARDS[0], {"q": "no answer"}, CARDS[1]]})
+    assert generate([(bad, False), (bad, False)]) == ([CARDS[0], CARDS[1]], 2)
+
+def test_gives_up_after_max_attempts_with_nothing_salvaged():
+    assert generate([("not json", False)], max_attempts=3) == ([], 3)
@@ -0,0 +1,93 @@
+"""
+Regression tests for cross-deck search: per-deck top-k and paging after parent deduplication.
+Uses hash-seeded fake embeddings (conftest.py), so no API key or network is needed.
+"""
+import time
+
+import pytest
+
+import rag_engine
+
+PARENTS_PER_DECK = 8
+
+@pytest.fixture(scope="module")
+def decks(tmp_path_factory, hash_embeddings):
+    workdir = tmp_path_factory.mktemp("search")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(rag_engine, "CHROMA_DIR", str(workdir / "chroma"))
+        mp.setattr(rag_engine, "DOC_STORE_DIR", str(workdir / "docs"))
+        mp.setattr(rag_engine, "FULL_VECTOR_DIR", str(workdir / "vectors"))
+        mp.setattr(rag_engine, "get_full_embeddings", hash_embeddings)
+        deck_ids = [f"deck-{d}" for d in range(3)]
+        for deck_id in deck_ids:
+            # ~1400-char pages: one parent each, split into several children
+            pages = [
+                " ".join(f"{deck_id} page {p} sentence {s} about topic {(p * s) % 7}." for s in range(25))
+                for p in range(PARENTS_PER_DECK)
+            ]
+            rag_engine.index_content(pages, deck_id, f"{deck_id}.pdf")
+        yield deck_ids
+
+def page_keys(res):
+    return [(r["deck_id"], r["page_start"]) for r in res["results"]]
+
+def test_single_deck_pages_through_every_parent(decks):
+    first = rag_engine.search_decks("topic 3", decks[:1], k_per_deck=PARENTS_PER_DECK, limit=5)
+    assert len(first["results"]) == 5
+    assert first["next_offset"] == 5
+
+    second = rag_engine.search_decks("topic 3", decks[:1], k_per_deck=PARENTS_PER_DECK, limit=5, offset=5)
+    assert len(second["results"]) == PARENTS_PER_DECK - 5
+    assert second["next_offset"] is None
+
+    seen = page_keys(first) + page_keys(second)
+    assert len(set(seen)) == PARENTS_PER_DECK
+
+def test_pages_match_one_big_page(decks):
+    whole = rag_engine.search_decks("topic 5", decks, k_per_deck=PARENTS_PER_DECK, limit=24)
+    paged = []
+    offset = 0
+    while offset is not None:
+        res = rag_engine.search_decks("topic 5", decks, k_per_deck=PARENTS_PER_DECK, limit=7, offset=offset)
+        paged += page_keys(res)
+        offset = res["next_offset"]
+    assert paged == page_keys(whole)
+    assert len(paged) == len(decks) * PARENTS_PER_DECK
+
+def test_each_deck_is_capped_at_k_per_deck(decks):
+    res = rag_engine.search_decks("topic 1", decks, k_per_deck=2, limit=10)
+    per_deck = {}
+    for deck_id, _ in page_keys(res):
+        per_deck[deck_id] = per_deck.get(deck_id, 0) + 1
+    assert per_deck == {deck_id: 2 for deck_id in decks}
+    assert res["next_offset"] is None
+
+def test_unknown_deck_returns_nothing(decks):
+    res = rag_engine.search_decks("topic 1", ["missing"])
+    assert res["results"] == [] and res["next_offset"] is None and res["searched_decks"] == 1
+
+def test_running_group_stops_requerying_at_the_deadline(monkeypatch, hash_embeddings):
+    from langchain_core.documents import Document
+    
+    calls = []
+    class SlowStore:
+        # Every child shares one parent, so the deck always looks short and would be re-queried
+        def similarity_search_by_vector_with_relevance_scores(self, vector, k, filter):
+            calls.append(k)
+            time.sleep(0.05)
+            return [(Document(page_content="c", metadata={"deck_id": "slow", "doc_id": "p"}), 0.1)] * min(k, 4096)
+    
+    monkeypatch.setattr(rag_engine, "get_vectorstore", SlowStore)
+    monkeypatch.setattr(rag_engine, "get_full_embeddings", hash_embeddings)
+    res = rag_engine.search_decks("q", ["slow"], k_per_deck=4, budget_ms=20)
+    assert res["timed_out_decks"] == ["slow"]
+    time.sleep(0.2) # Let the abandoned group finish its in-flight query
+    assert len(calls) == 1
+
+def test_source_files_restrict_every_deck(decks):
+    res = rag_engine.search_decks(
+        "topic 2", decks, k_per_deck=PARENTS_PER_DECK, limit=50, source_files=["deck-1.pdf", "deck-2.pdf"]
+    )
+    assert {deck_id for deck_id, _ in page_keys(res)} == {"deck-1", "deck-2"}
+    assert {r["source"] for r in res["results"]} == {"deck-1.pdf", "deck-2.pdf"}
+    assert len(res["results"]) == 2 * PARENTS_PER_DECK
@@ -1,17 +1,49 @@
+import os
 import fitz  # PyMuPDF
 import base64
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# --- CONFIG ---
+EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+_extract_pool = None
+
+def get_extract_pool() -> ProcessPoolExecutor:
+    """
+    PyMuPDF is not thread-safe, so uploads are parsed in worker processes instead of threads.
+    Workers are spawned (not forked) so they never inherit the server's threads or locks.
+    """
+    global _extract_pool
+    if _extract_pool is None:
+        _extract_pool = ProcessPoolExecutor(
+            max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _extract_pool
+
+def reset_extract_pool(broken: ProcessPoolExecutor):
+    """
+    Drops a pool whose worker died (PyMuPDF segfault, OOM kill) so later uploads get a fresh one.
+    Only the pool that broke is dropped, so concurrent callers never tear down its replacement.
+    """
+    global _extract_pool
+    if _extract_pool is broken:
+        _extract_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
 
 def process_pdf(file_stream):
     """
     Analyzes PDF. Returns:
     {
         "mode": "text" | "image",
-        "content": str (text) | List[str] (base64 images)
+        "pages": List[str] (per-page text or base64 image, 1 entry per page)
     }
+    (No joined 'content' copy: the result is pickled back from the extraction pool, and callers use 'pages'.)
+    Accepts a file-like object or the raw bytes (what the extraction pool is sent).
     """
-    doc = fitz.open(stream=file_stream.read(), filetype="pdf")
+    data = file_stream if isinstance(file_stream, (bytes, bytearray)) else file_stream.read()
+    doc = fitz.open(stream=data, filetype="pdf")
     
-    text_accumulated = ""
     images_accumulated = []
     
     # 1. Check first few pages for text density
@@ -30,9 +62,10 @@ def process_pdf(file_stream):
             b64 = base64.b64encode(data).decode('utf-8')
             images_accumulated.append(b64)
             
-        return {"mode": "image", "content": images_accumulated}
+        return {"mode": "image", "pages": images_accumulated}
     else:
         print("DEBUG: Text PDF detected. Using TEXT mode.")
+        page_texts = []
         for page in doc:
-            text_accumulated += page.get_text() + "\n"
-        return {"mode": "text", "content": text_accumulated}
+            page_texts.append(page.get_text() + "\n")
+        return {"mode": "text", "pages": page_texts}